@@ -0,0 +1,209 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paulina Budzoń <https://github.com/pbudzon>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Clients, retries and concurrency limits of AWS calls, shared by backup-rds.py and ebs-snapshots.py (zip this file
+# together with them)
+
+import random
+import threading
+import time
+
+import boto3
+import botocore
+import botocore.config
+
+# How many times to retry a throttled call (or one failed with a transient error) before giving up
+MAX_RETRIES = 5
+# Maximum number of seconds to wait before retrying a call
+MAX_BACKOFF = 20
+# Error codes returned when we should slow down and try again
+THROTTLING_ERRORS = ("Throttling", "ThrottlingException", "RequestLimitExceeded",
+                     "SnapshotCreationPerVolumeRateExceeded")
+# Error codes and HTTP status codes of transient failures, which are retried like throttled calls
+TRANSIENT_ERRORS = ("InternalFailure", "InternalError", "ServiceUnavailable", "Unavailable", "RequestTimeout",
+                    "RequestTimeoutException")
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+# Maximum number of concurrent calls of each API in a region, shared by all workers
+API_CONCURRENCY = {
+    "create_snapshots": 5,
+    "delete_snapshot": 5,
+    "copy_db_snapshot": 5,
+    "copy_db_cluster_snapshot": 5,
+    "delete_db_snapshot": 5,
+    "delete_db_cluster_snapshot": 5,
+}
+# Maximum number of concurrent calls of APIs not listed in API_CONCURRENCY
+DEFAULT_CONCURRENCY = 10
+# Maximum number of seconds to wait for a connection to AWS and for each response
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 7
+# How many seconds before Lambda timeout to stop starting new work - enough for a call started just before
+# that to time out and for the results to be saved
+DEADLINE_MARGIN = CONNECT_TIMEOUT + READ_TIMEOUT + 2
+
+# Configuration of all clients: botocore doesn't retry (throttled and transient failures are retried by
+# call_with_backoff, within the deadline and without holding API budget while waiting), but still slows down all calls
+# of the client when throttled (adaptive mode), and requests can't hang past Lambda timeout
+CLIENT_CONFIG = botocore.config.Config(
+    retries={"mode": "adaptive", "total_max_attempts": 1},
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+)
+
+# Semaphores limiting concurrent calls, by region and API
+API_BUDGETS = {}
+API_BUDGETS_LOCK = threading.Lock()
+
+
+def create_client(service, region, max_pool_connections):
+    """
+    Creates boto3 client with CLIENT_CONFIG
+    :param service: string Name of the AWS service
+    :param region: string Name of the region or None for the region Lambda runs in
+    :param max_pool_connections: int Maximum number of connections kept open, at least the number of parallel workers
+    :return: boto3 client
+    """
+    config = CLIENT_CONFIG.merge(botocore.config.Config(max_pool_connections=max_pool_connections))
+    return boto3.client(service, region_name=region, config=config)
+
+
+def get_deadline(context):
+    """
+    Calculates the time at which we should stop starting new work and retrying failed calls
+    :param context: Lambda context object
+    :return: float Unix timestamp
+    """
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN
+
+
+def get_api_budget(function):
+    """
+    Returns semaphore limiting concurrent calls of the API to API_CONCURRENCY (or DEFAULT_CONCURRENCY if not listed
+    there)
+    :param function: Bound boto3 client method
+    :return: threading.BoundedSemaphore shared by all calls of the API in the client's region
+    """
+    key = (function.__self__.meta.region_name, function.__name__)
+    with API_BUDGETS_LOCK:
+        if key not in API_BUDGETS:
+            API_BUDGETS[key] = threading.BoundedSemaphore(API_CONCURRENCY.get(function.__name__, DEFAULT_CONCURRENCY))
+
+        return API_BUDGETS[key]
+
+
+def get_backoff(attempt, deadline):
+    """
+    Calculates how long to wait before retrying failed call: random (full jitter), exponentially growing up
+    to MAX_BACKOFF
+    :param attempt: int Number of the failed attempt, starting from 0
+    :param deadline: float Unix timestamp by which the retry needs to be done or None for no limit
+    :return: float Number of seconds to wait or None if retry wouldn't happen before the deadline
+    """
+    delay = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+    if deadline is not None and time.time() + delay > deadline:
+        return None
+
+    return delay
+
+
+def is_retryable(error):
+    """
+    Checks if failed call can be retried: when throttled, on server errors and on connection failures or timeouts
+    :param error: Exception raised by the call
+    :return: True if the call can be retried
+    """
+    if isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+
+    if isinstance(error, botocore.exceptions.ClientError):
+        return (error.response["Error"].get("Code") in THROTTLING_ERRORS + TRANSIENT_ERRORS or
+                error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") in TRANSIENT_STATUS_CODES)
+
+    return False
+
+
+def get_error_code(error):
+    """
+    :param error: Exception raised by the call
+    :return: string Error code returned by the API or name of the exception if the call failed before getting a response
+    """
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response["Error"].get("Code")
+
+    return type(error).__name__
+
+
+def call_with_backoff(function, deadline, before_retry=None, **kwargs):
+    """
+    Calls API function within its concurrency budget, retrying with exponential backoff (and jitter) when the request
+    is throttled or fails with a transient error (see is_retryable)
+    :param function: Bound boto3 client method to call
+    :param deadline: float Unix timestamp after which the call is not retried anymore
+    :param before_retry: Function called with the error right before each retry (after the backoff), which is given up
+    when it returns False, or None
+    :param kwargs: Arguments for the call
+    :return: Response from the call
+    :raises botocore.exceptions.ClientError or botocore.exceptions.BotoCoreError if the call fails or is still
+    throttled (or failing) after MAX_RETRIES retries or at the deadline
+    """
+    budget = get_api_budget(function)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with budget:
+                return function(**kwargs)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            if not is_retryable(e) or attempt == MAX_RETRIES:
+                raise e
+
+            delay = get_backoff(attempt, deadline)
+            if delay is None:
+                raise e
+
+            print("Call to {} failed ({}), retrying in {:.2f}s".format(
+                function.__self__.meta.service_model.service_name, get_error_code(e), delay))
+            time.sleep(delay)
+            if before_retry is not None and not before_retry(e):
+                raise e
+
+
+def get_pages(function, deadline, token_name="NextToken", **kwargs):
+    """
+    Calls paginated API function page by page, each call made with call_with_backoff
+    :param function: Bound boto3 client method to call
+    :param deadline: float Unix timestamp after which throttled calls are not retried anymore
+    :param token_name: string Name of the pagination token of the API (NextToken for most, Marker for RDS)
+    :param kwargs: Arguments for the call, including the token of the page to start from (None to start from the first)
+    :return: Generator of (page token, response) tuples, where page token is the token needed to fetch the page again
+    (None for the first page)
+    """
+    page_token = kwargs.pop(token_name, None)
+    while True:
+        if page_token is not None:
+            kwargs[token_name] = page_token
+
+        response = call_with_backoff(function, deadline, **kwargs)
+        yield page_token, response
+
+        page_token = response.get(token_name)
+        if not page_token:
+            return
@@ -20,250 +20,1070 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import datetime
+import heapq
 import json
 import operator
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import botocore
 
+from aws_calls import call_with_backoff, create_client, get_deadline, get_pages
+
 # Env variables
 SOURCE_REGION = os.environ.get("SOURCE_REGION")
-TARGET_REGION = os.environ.get("TARGET_REGION")
+# Comma-delimited list of regions to copy snapshots to
+TARGET_REGIONS = [region.strip() for region in os.environ.get("TARGET_REGIONS", os.environ.get("TARGET_REGION", ""))
+                  .split(",") if region.strip()]
+# KMS key for single target region or comma-delimited list of KMS key ARNs, one in each of target regions
 KMS_KEY_ID = os.environ.get("KMS_KEY_ID", "")
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "5"))
+# How many copies to keep in target region: latest ones from that many days, weeks and months
+KEEP_DAILY = max(1, int(os.environ.get("KEEP_DAILY") or "1"))
+KEEP_WEEKLY = int(os.environ.get("KEEP_WEEKLY") or "0")
+KEEP_MONTHLY = int(os.environ.get("KEEP_MONTHLY") or "0")
+# Whether to report progress of copies still in progress in target region
+TRACK_COPIES = os.environ.get("TRACK_COPIES", "No") == "Yes"
+# Path of SSM parameters (one for each copy in progress, named after its target region and the copy) with time the copy
+# started, so copies finishing after the run are reported by the next one - empty to only report progress within a run
+COPIES_PATH = os.environ.get("COPIES_PATH", "")
+# Path of SSM parameters (one for each Aurora cluster, named after it) with time of its latest copied snapshot,
+# empty to always check all clusters
+WATERMARK_PATH = os.environ.get("WATERMARK_PATH", "")
+
+# How many seconds before the deadline (DEADLINE_MARGIN before Lambda timeout, see aws_calls.py) to stop starting
+# backups of more databases, so the started ones can finish
+START_MARGIN = 5
 
-# Global clients
-SOURCE_CLIENT = boto3.client("rds", SOURCE_REGION)
-TARGET_CLIENT = boto3.client("rds", TARGET_REGION)
+# RDS clients, by region
+RDS_CLIENTS = {}
+RDS_CLIENTS_LOCK = threading.Lock()
 
 
-def get_snapshots_list(response, is_aurora):
+def get_rds_client(region):
     """
-    Simplifies list of snapshots by retaining snapshot name and creation time only
-    :param response: dict Output from describe_db_snapshots or describe_db_cluster_snapshots
-    :param is_aurora: bool True if output if from describe_db_cluster_snapshots, False otherwise
-    :return: Dict with snapshot id as key and snapshot creation time as value
+    Returns RDS client for the region, creating it on first use
+    :param region: string Name of the region
+    :return: boto3 RDS client
     """
-    snapshots = {}
+    with RDS_CLIENTS_LOCK:
+        if region not in RDS_CLIENTS:
+            RDS_CLIENTS[region] = create_client("rds", region, MAX_WORKERS * 2)
+
+        return RDS_CLIENTS[region]
 
-    response_list_key = "DBClusterSnapshots" if is_aurora else "DBSnapshots"
-    identifier_list_key = "DBClusterSnapshotIdentifier" if is_aurora else "DBSnapshotIdentifier"
-    for snapshot in response[response_list_key]:
-        if snapshot["Status"] != "available":
-            continue
 
-        snapshots[snapshot[identifier_list_key]] = snapshot["SnapshotCreateTime"]
+class Snapshot(collections.namedtuple("Snapshot", ["identifier", "create_time", "encrypted", "kms_key_id", "engine"])):
+    """
+    Details of a single RDS snapshot or Aurora cluster snapshot needed to copy it
+    """
+    __slots__ = ()
 
-    return snapshots
+    @classmethod
+    def from_response(cls, snapshot, is_aurora):
+        """
+        :param snapshot: dict Snapshot from describe_db_snapshots or describe_db_cluster_snapshots output
+        :param is_aurora: bool True if snapshot is from describe_db_cluster_snapshots, False otherwise
+        :return: Snapshot
+        """
+        return cls(
+            identifier=snapshot["DBClusterSnapshotIdentifier" if is_aurora else "DBSnapshotIdentifier"],
+            create_time=snapshot["SnapshotCreateTime"],
+            encrypted=snapshot["StorageEncrypted" if is_aurora else "Encrypted"],
+            kms_key_id=snapshot.get("KmsKeyId"),
+            engine=snapshot.get("Engine"),
+        )
 
 
-def print_encryption_info(source_snapshot_arn, is_aurora):
+def get_snapshots_list(snapshots_list, is_aurora):
     """
-    Prints out info about encryption for the snapshot copy. Can be skipped completely, only used for more detailed logs.
-    :param source_snapshot_arn: string ARN of the source snapshot
-    :param is_aurora: bool True it it's Aurora cluster snapshot, False otherwise
-    :return: None
+    Simplifies list of snapshots by retaining details of available ones only
+    :param snapshots_list: Iterable of snapshots from describe_db_snapshots or describe_db_cluster_snapshots output
+    :param is_aurora: bool True if snapshots are from describe_db_cluster_snapshots, False otherwise
+    :return: Generator of Snapshot
+    """
+    for snapshot in snapshots_list:
+        if snapshot["Status"] == "available":
+            yield Snapshot.from_response(snapshot, is_aurora)
+
+
+def get_automated_snapshots(instance_name, is_aurora, deadline):
     """
+    Lists automated snapshots of the instance/cluster in source region, reading all pages of the output
+    :param instance_name: string Name of the instance/cluster
+    :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Generator of snapshots from describe_db_snapshots or describe_db_cluster_snapshots output
+    """
+    rds_client = get_rds_client(SOURCE_REGION)
     if is_aurora:
-        snapshot_details = SOURCE_CLIENT.describe_db_cluster_snapshots(
-            DBClusterSnapshotIdentifier=source_snapshot_arn,
-        )
+        response_iterator = get_pages(rds_client.describe_db_cluster_snapshots, deadline, "Marker",
+                                      DBClusterIdentifier=instance_name, SnapshotType="automated")
     else:
-        snapshot_details = SOURCE_CLIENT.describe_db_snapshots(
-            DBSnapshotIdentifier=source_snapshot_arn,
-        )
+        response_iterator = get_pages(rds_client.describe_db_snapshots, deadline, "Marker",
+                                      DBInstanceIdentifier=instance_name, SnapshotType="automated")
+
+    for _, response in response_iterator:
+        for snapshot in response["DBClusterSnapshots" if is_aurora else "DBSnapshots"]:
+            yield snapshot
+
+
+def get_kms_key_id(region):
+    """
+    Finds KMS key to encrypt copies in given target region with
+    :param region: string Target region
+    :return: string KMS key ID/ARN or empty string if copies in that region should not be encrypted
+    """
+    keys = [key.strip() for key in KMS_KEY_ID.split(",") if key.strip()]
+
+    # Any form of key ID is fine with single target region
+    if len(TARGET_REGIONS) == 1 and len(keys) == 1:
+        return keys[0]
+
+    # Otherwise, match key ARNs by their region
+    for key in keys:
+        if key.startswith("arn:") and key.split(":")[3] == region:
+            return key
+
+    return ""
+
+
+def get_newest_snapshots(snapshots, count):
+    """
+    Finds the newest snapshots, without sorting (or keeping in memory) all of them
+    :param snapshots: Iterable of Snapshot
+    :param count: int How many snapshots to return
+    :return: List of up to count newest Snapshot, newest first
+    """
+    return heapq.nlargest(count, snapshots, key=operator.attrgetter("create_time"))
+
+
+class TargetInventory(object):
+    """
+    Manual snapshots in one of target regions, listed once per invocation and indexed by source database/cluster name.
+    Used both to check if the snapshot is already copied and to find old copies to remove.
+    """
+
+    def __init__(self, region, is_aurora, deadline, instance_name=None):
+        """
+        :param region: string Target region
+        :param is_aurora: bool True to list Aurora cluster snapshots, False for RDS instance snapshots
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        :param instance_name: string Name of the instance/cluster to limit the list to, or None to list all
+        """
+        self.region = region
+        self.is_aurora = is_aurora
+        self.instance_name = instance_name
+        self.by_identifier = {}
+        self.by_instance = {}
+        self.lock = threading.Lock()
+
+        kwargs = {"SnapshotType": "manual"}
+        if is_aurora:
+            function = get_rds_client(region).describe_db_cluster_snapshots
+            response_list_key = "DBClusterSnapshots"
+            if instance_name:
+                kwargs["DBClusterIdentifier"] = instance_name
+        else:
+            function = get_rds_client(region).describe_db_snapshots
+            response_list_key = "DBSnapshots"
+            if instance_name:
+                kwargs["DBInstanceIdentifier"] = instance_name
+
+        for _, response in get_pages(function, deadline, "Marker", **kwargs):
+            for snapshot in response[response_list_key]:
+                self.add(snapshot)
+
+    def add(self, snapshot):
+        """
+        Adds snapshot to the inventory (for example a new copy)
+        :param snapshot: dict Snapshot details from describe or copy call
+        """
+        identifier = snapshot["DBClusterSnapshotIdentifier" if self.is_aurora else "DBSnapshotIdentifier"]
+        instance_name = snapshot["DBClusterIdentifier" if self.is_aurora else "DBInstanceIdentifier"]
+        with self.lock:
+            self.by_identifier[identifier] = snapshot
+            self.by_instance.setdefault(instance_name, []).append(snapshot)
+
+    def exists(self, snapshot_identifier):
+        """
+        :param snapshot_identifier: string Name of the snapshot
+        :return: True if the snapshot exists in target region
+        """
+        with self.lock:
+            return snapshot_identifier in self.by_identifier
+
+    def get(self, snapshot_identifier):
+        """
+        :param snapshot_identifier: string Name of the snapshot
+        :return: dict Snapshot details or None if it's not in target region
+        """
+        with self.lock:
+            return self.by_identifier.get(snapshot_identifier)
+
+    def get_in_progress(self):
+        """
+        :return: List of snapshots in target region which are still being created (copied)
+        """
+        with self.lock:
+            return [snapshot for snapshot in self.by_identifier.values()
+                    if snapshot["Status"] in ("pending", "creating", "copying")]
+
+    def get_snapshots(self, instance_name):
+        """
+        :param instance_name: string Name of the instance/cluster
+        :return: List of snapshots of the instance/cluster in target region
+        """
+        with self.lock:
+            return list(self.by_instance.get(instance_name, []))
+
+
+def get_inventories(is_aurora, deadline, instance_name=None):
+    """
+    Lists snapshots in all target regions at the same time
+    :param is_aurora: bool True to list Aurora cluster snapshots, False for RDS instance snapshots
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :param instance_name: string Name of the instance/cluster to limit the list to, or None to list all
+    :return: Dict with target region as key and its TargetInventory as value
+    """
+    with ThreadPoolExecutor(max_workers=len(TARGET_REGIONS)) as executor:
+        inventories = list(executor.map(lambda region: TargetInventory(region, is_aurora, deadline, instance_name),
+                                        TARGET_REGIONS))
 
+    return dict(zip(TARGET_REGIONS, inventories))
+
+
+def print_encryption_info(snapshot, kms_key_id):
+    """
+    Prints out info about encryption for the snapshot copy. Can be skipped completely, only used for more detailed logs.
+    :param snapshot: Snapshot Source snapshot
+    :param kms_key_id: string KMS key used for the copy
+    :return: None
+    """
     # No key, but snapshot is encrypted
-    if KMS_KEY_ID == "" and (
-            (not is_aurora and snapshot_details["DBSnapshots"][0]["Encrypted"]) or
-            (is_aurora and snapshot_details["DBClusterSnapshots"][0]["StorageEncrypted"])
-    ):
+    if kms_key_id == "" and snapshot.encrypted:
         raise Exception(
             "Snapshot is encrypted, but no encryption key specified for copy! " +
             "Set KMS Key ID parameter in CloudFormation stack")
 
     # Key provided, but snapshot not encrypted (notice only)
-    if KMS_KEY_ID != "" and (
-            (not is_aurora and not snapshot_details["DBSnapshots"][0]["Encrypted"]) or
-            (is_aurora and not snapshot_details["DBClusterSnapshots"][0]["StorageEncrypted"])
-    ):
+    if kms_key_id != "" and not snapshot.encrypted:
         print("Snapshot is not encrypted, but KMS key specified - copy WILL BE encrypted")
 
 
-def get_clusters(clusters_to_use):
+def get_clusters(clusters_to_use, deadline):
     """
-    Gets a list of Aurora clusters and matches that against CLUSTERS_TO_USE env variable (if provided).
+    Gets Aurora clusters matching CLUSTERS_TO_USE env variable (if provided), page by page.
     :param clusters_to_use: List of cluster names
-    :return: List of Aurora cluster names that match CLUSTERS_TO_USE (or all, if CLUSTERS_TO_USE is empty)
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Generator of Aurora cluster names that match CLUSTERS_TO_USE (or all, if CLUSTERS_TO_USE is empty)
     """
-    clusters = []
-    clusters_list = SOURCE_CLIENT.describe_db_clusters()
-    for cluster in clusters_list['DBClusters']:
-        if (clusters_to_use and cluster['DBClusterIdentifier'] in clusters_to_use) or (not clusters_to_use):
-            clusters.append(cluster['DBClusterIdentifier'])
+    filters = []
+    if clusters_to_use:
+        filters.append({"Name": "db-cluster-id", "Values": clusters_to_use})
 
-    return clusters
+    for _, clusters_list in get_pages(get_rds_client(SOURCE_REGION).describe_db_clusters, deadline, "Marker",
+                                      Filters=filters):
+        for cluster in clusters_list['DBClusters']:
+            yield cluster['DBClusterIdentifier']
 
 
-def copy_latest_snapshot(account_id, instance_name, is_aurora):
+def get_latest_snapshot(instance_name, is_aurora, deadline):
     """
-    Finds the latest snapshot for a given RDS instance/Aurora Cluster and copies it to target region.
+    Finds the latest snapshot for a given RDS instance/Aurora Cluster in source region.
+    :param instance_name: string Name of the instance/cluster
+    :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Snapshot
+    :raises Exception if instance/cluster has no automated snapshots
+    """
+
+    # Go through automated snapshots for this database and get the latest one
+    snapshots = get_snapshots_list(get_automated_snapshots(instance_name, is_aurora, deadline), is_aurora)
+    latest_snapshots = get_newest_snapshots(snapshots, 1)
+    if len(latest_snapshots) == 0:
+        raise Exception("No automated snapshots found for {} {}".format(
+            "cluster" if is_aurora else "database", instance_name))
+
+    snapshot = latest_snapshots[0]
+    print("Latest snapshot found: '{}' from {}".format(snapshot.identifier, snapshot.create_time))
+    return snapshot
+
+
+def copy_snapshot(account_id, instance_name, snapshot, is_aurora, inventory, deadline):
+    """
+    Copies given snapshot of RDS instance/Aurora Cluster to target region, unless it's already there.
     :param account_id: int ID of the current AWS account
     :param instance_name: string Name of the instance/cluster
+    :param snapshot: Snapshot to copy
     :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param inventory: TargetInventory of snapshots in target region to copy to
+    :param deadline: float Unix timestamp after which throttled calls are not retried
     :return: None
-    :raises Exception if instance/cluster has no automated snapshots or copy operation fails
+    :raises Exception if copy operation fails
     """
+    target_region = inventory.region
+    copy_name = "{}-{}-{}".format(instance_name, SOURCE_REGION, snapshot.identifier.replace(":", "-"))
+    print("Checking if '{}' exists in {}".format(copy_name, target_region))
 
-    # Get a list of automated snapshots for this database
+    # Look for the copy_name snapshot in target region
+    if inventory.exists(copy_name):
+        print("{} is already copied to {}".format(copy_name, target_region))
+        return
+
+    snapshot_arn_name = "cluster-snapshot" if is_aurora else "snapshot"
+    source_snapshot_arn = "arn:aws:rds:{}:{}:{}:{}".format(SOURCE_REGION, account_id, snapshot_arn_name,
+                                                           snapshot.identifier)
+
+    kms_key_id = get_kms_key_id(target_region)
+    print_encryption_info(snapshot, kms_key_id)
+
+    # Trigger a copy operation
     if is_aurora:
-        response = SOURCE_CLIENT.describe_db_cluster_snapshots(
-            DBClusterIdentifier=instance_name,
-            SnapshotType="automated"
+        response_list_key = "DBClusterSnapshot"
+        response = call_with_backoff(
+            get_rds_client(target_region).copy_db_cluster_snapshot,
+            deadline,
+            SourceDBClusterSnapshotIdentifier=source_snapshot_arn,
+            TargetDBClusterSnapshotIdentifier=copy_name,
+            CopyTags=True,
+            KmsKeyId=kms_key_id,
+            SourceRegion=SOURCE_REGION
         )
-        if len(response["DBClusterSnapshots"]) == 0:
-            raise Exception("No automated snapshots found for cluster " + instance_name)
     else:
-        response = SOURCE_CLIENT.describe_db_snapshots(
-            DBInstanceIdentifier=instance_name,
-            SnapshotType="automated"
+        response_list_key = "DBSnapshot"
+        response = call_with_backoff(
+            get_rds_client(target_region).copy_db_snapshot,
+            deadline,
+            SourceDBSnapshotIdentifier=source_snapshot_arn,
+            TargetDBSnapshotIdentifier=copy_name,
+            CopyTags=True,
+            KmsKeyId=kms_key_id,
+            SourceRegion=SOURCE_REGION  # Ref: https://github.com/boto/botocore/issues/1273
         )
 
-        if len(response["DBSnapshots"]) == 0:
-            raise Exception("No automated snapshots found for database " + instance_name)
+    # Check the status of the copy
+    if response[response_list_key]["Status"] not in ("pending", "available", "copying"):
+        raise Exception("Copy operation for {} failed!".format(copy_name))
 
-    # Order the list of snapshots by creation time
-    snapshots = get_snapshots_list(response, is_aurora)
+    inventory.add(response[response_list_key])
+    print("Copied {} to {}".format(copy_name, target_region))
 
-    # Get the latest snapshot
-    snapshot_name, snapshot_time = sorted(snapshots.items(), key=operator.itemgetter(1)).pop()
-    print("Latest snapshot found: '{}' from {}".format(snapshot_name, snapshot_time))
-    copy_name = "{}-{}-{}".format(instance_name, SOURCE_REGION, snapshot_name.replace(":", "-"))
-    print("Checking if '{}' exists in target region".format(copy_name))
 
-    # Look for the copy_name snapshot in target region
-    try:
-        if is_aurora:
-            TARGET_CLIENT.describe_db_cluster_snapshots(
-                DBClusterSnapshotIdentifier=copy_name
-            )
-        else:
-            TARGET_CLIENT.describe_db_snapshots(
-                DBSnapshotIdentifier=copy_name
-            )
+def get_snapshots_to_keep(snapshots):
+    """
+    Applies retention policy: keeps the latest snapshot from each of KEEP_DAILY latest days, KEEP_WEEKLY latest weeks
+    and KEEP_MONTHLY latest months that have any snapshots. The latest snapshot is always kept.
+    Snapshots are read once, keeping only the latest one of each day, week and month, without sorting them.
+    :param snapshots: Iterable of Snapshot
+    :return: Set of identifiers of snapshots to keep
+    """
+    buckets = (
+        (KEEP_DAILY, lambda snapshot: snapshot.create_time.date()),
+        (KEEP_WEEKLY, lambda snapshot: snapshot.create_time.isocalendar()[:2]),
+        (KEEP_MONTHLY, lambda snapshot: (snapshot.create_time.year, snapshot.create_time.month)),
+    )
 
-        print("{} is already copied to {}".format(copy_name, TARGET_REGION))
-    except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] in ("DBSnapshotNotFound", "DBClusterSnapshotNotFoundFault"):
-            snapshot_arn_name = "cluster-snapshot" if is_aurora else "snapshot"
-            source_snapshot_arn = "arn:aws:rds:{}:{}:{}:{}".format(SOURCE_REGION, account_id, snapshot_arn_name,
-                                                                   snapshot_name)
-
-            print_encryption_info(source_snapshot_arn, is_aurora)
-
-            # Trigger a copy operation
-            if is_aurora:
-                response_list_key = "DBClusterSnapshot"
-                response = TARGET_CLIENT.copy_db_cluster_snapshot(
-                    SourceDBClusterSnapshotIdentifier=source_snapshot_arn,
-                    TargetDBClusterSnapshotIdentifier=copy_name,
-                    CopyTags=True,
-                    KmsKeyId=KMS_KEY_ID,
-                    SourceRegion=SOURCE_REGION
-                )
-            else:
-                response_list_key = "DBSnapshot"
-                response = TARGET_CLIENT.copy_db_snapshot(
-                    SourceDBSnapshotIdentifier=source_snapshot_arn,
-                    TargetDBSnapshotIdentifier=copy_name,
-                    CopyTags=True,
-                    KmsKeyId=KMS_KEY_ID,
-                    SourceRegion=SOURCE_REGION  # Ref: https://github.com/boto/botocore/issues/1273
-                )
-
-            # Check the status of the copy
-            if response[response_list_key]["Status"] not in ("pending", "available", "copying"):
-                raise Exception("Copy operation for {} failed!".format(copy_name))
-
-            print("Copied {} to {}".format(copy_name, TARGET_REGION))
-            return
-        else:  # Another error happened, re-raise
-            raise e
+    # Latest snapshot in each day, week and month
+    latest = [{} for _ in buckets]
+    for snapshot in snapshots:
+        for (count, get_bucket), latest_in_buckets in zip(buckets, latest):
+            if count <= 0:
+                continue
 
+            bucket = get_bucket(snapshot)
+            if bucket not in latest_in_buckets or snapshot.create_time > latest_in_buckets[bucket].create_time:
+                latest_in_buckets[bucket] = snapshot
 
-def remove_old_snapshots(instance_name, is_aurora):
+    # Latest snapshots of the newest buckets are the newest of the latest snapshots of all buckets
+    to_keep = set()
+    for (count, _), latest_in_buckets in zip(buckets, latest):
+        to_keep.update(snapshot.identifier for snapshot in get_newest_snapshots(latest_in_buckets.values(), count))
+
+    return to_keep
+
+
+def delete_snapshot(snapshot_identifier, is_aurora, target_region, deadline):
     """
-    Finds previously-copied snapshots for given RDS instance / Aurora cluster in target regions and leaves only latest one.
+    Deletes a snapshot in target region, retrying when throttled
+    :param snapshot_identifier: string Name of the snapshot
+    :param is_aurora: bool True if it's Aurora cluster snapshot, False otherwise
+    :param target_region: string Target region of the snapshot
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    """
+    print("Removing {} in {}".format(snapshot_identifier, target_region))
+    if is_aurora:
+        call_with_backoff(
+            get_rds_client(target_region).delete_db_cluster_snapshot,
+            deadline,
+            DBClusterSnapshotIdentifier=snapshot_identifier
+        )
+    else:
+        call_with_backoff(
+            get_rds_client(target_region).delete_db_snapshot,
+            deadline,
+            DBSnapshotIdentifier=snapshot_identifier
+        )
+
+
+def remove_old_snapshots(instance_name, is_aurora, inventory, deadline):
+    """
+    Finds previously-copied snapshots for given RDS instance / Aurora cluster in target regions and leaves only those
+    required by retention policy (by default: latest one).
     :param instance_name: string Name of the instance/cluster
     :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param inventory: TargetInventory of snapshots in target region
+    :param deadline: float Unix timestamp after which throttled calls are not retried
     :return: None
     :raises Exception if instance/cluster has no snapshots in target region
     """
 
     # Get a list of all snapshots for this database in target region
-    if is_aurora:
-        response = TARGET_CLIENT.describe_db_cluster_snapshots(
-            SnapshotType="manual",
-            DBClusterIdentifier=instance_name
-        )
+    snapshots_list = inventory.get_snapshots(instance_name)
+    if len(snapshots_list) == 0:
+        raise Exception("No snapshots for {} {} found in {}".format(
+            "cluster" if is_aurora else "database", instance_name, inventory.region))
 
-        if len(response["DBClusterSnapshots"]) == 0:
-            raise Exception("No snapshots for cluster {} found in target region".format(instance_name))
-    else:
-        response = TARGET_CLIENT.describe_db_snapshots(
-            SnapshotType="manual",
-            DBInstanceIdentifier=instance_name
-        )
+    # Apply retention policy to available snapshots and get all the others
+    snapshots = list(get_snapshots_list(snapshots_list, is_aurora))
+    to_keep = get_snapshots_to_keep(snapshots)
+    snapshots_to_remove = [i.identifier for i in snapshots if i.identifier not in to_keep]
+    if len(snapshots_to_remove) == 0:
+        print("No old snapshots to remove in {}".format(inventory.region))
+        return
+
+    print("Found {} snapshot(s) to remove in {}, keeping {}".format(
+        len(snapshots_to_remove), inventory.region, len(to_keep)))
+
+    # Remove the snapshots, up to MAX_WORKERS at the same time
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(delete_snapshot, snapshot, is_aurora, inventory.region, deadline)
+                   for snapshot in snapshots_to_remove]
+
+    # Re-raise the first error, if any of the deletions failed
+    for future in futures:
+        future.result()
+
+
+def backup_to_region(account_id, instance_name, snapshot, is_aurora, inventory, deadline):
+    """
+    Copies given snapshot to one of target regions and removes old copies there.
+    :param account_id: int ID of the current AWS account
+    :param instance_name: string Name of the instance/cluster
+    :param snapshot: Snapshot to copy
+    :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param inventory: TargetInventory of snapshots in the target region
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    """
+    copy_snapshot(account_id, instance_name, snapshot, is_aurora, inventory, deadline)
+    remove_old_snapshots(instance_name, is_aurora, inventory, deadline)
+
+
+def backup_snapshot(account_id, instance_name, snapshot, is_aurora, inventories, deadline):
+    """
+    Copies given snapshot to all target regions and removes old copies there, in all regions at the same time.
+    Failure in one region doesn't stop the others.
+    :param account_id: int ID of the current AWS account
+    :param instance_name: string Name of the instance/cluster
+    :param snapshot: Snapshot to copy
+    :param is_aurora: bool True if instance_name is name of Aurora cluster, False otherwise
+    :param inventories: Dict with target region as key and its TargetInventory as value
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    :raises Exception if backup failed in any of the regions
+    """
+    with ThreadPoolExecutor(max_workers=len(inventories)) as executor:
+        futures = {
+            region: executor.submit(backup_to_region, account_id, instance_name, snapshot, is_aurora, inventory,
+                                    deadline)
+            for region, inventory in inventories.items()
+        }
+
+    failures = ["{}: {}".format(region, future.exception()) for region, future in futures.items()
+                if future.exception() is not None]
+    if failures:
+        raise Exception("Backup of {} failed in {} of {} region(s): {}".format(
+            instance_name, len(failures), len(futures), "; ".join(failures)))
+
+
+def backup_instance(account_id, instance_name, inventories, deadline):
+    """
+    Copies the latest snapshot of RDS instance to target regions and removes older copies, unless there's no time left
+    to start it.
+    :param account_id: int ID of the current AWS account
+    :param instance_name: string Name of the instance
+    :param inventories: Dict with target region as key and TargetInventory of snapshots there as value
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: True if backup was done, False if it wasn't started because it's less than START_MARGIN seconds
+    before the deadline
+    """
+    if time.time() > deadline - START_MARGIN:
+        return False
+
+    # Look up the snapshot in source region once for all target regions
+    snapshot = get_latest_snapshot(instance_name, False, deadline)
+    backup_snapshot(account_id, instance_name, snapshot, False, inventories, deadline)
+    return True
+
+
+def backup_instances(account_id, instances, deadline):
+    """
+    Backs up RDS instances, up to MAX_WORKERS at the same time. Failure of one instance doesn't stop the others.
+    Instances which can't be started before the deadline are reported as failed, so they can be retried.
+    :param account_id: int ID of the current AWS account
+    :param instances: List of instance names
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Dict with names of instances which failed (or weren't started) as keys and their errors as values
+    """
+    # List snapshots in target regions once for all instances (only for that instance, if there's just one)
+    inventories = get_inventories(False, deadline, instances[0] if len(instances) == 1 else None)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for instance_name in instances:
+            futures[instance_name] = executor.submit(backup_instance, account_id, instance_name, inventories, deadline)
+
+    failures = {}
+    not_started = []
+    for instance_name, future in futures.items():
+        if future.exception() is not None:
+            print("Backup of database {} failed: {}".format(instance_name, future.exception()))
+            failures[instance_name] = future.exception()
+        elif not future.result():
+            not_started.append(instance_name)
+            failures[instance_name] = Exception("Not started before Lambda timeout")
 
-        if len(response["DBSnapshots"]) == 0:
-            raise Exception("No snapshots for database {} found in target region".format(instance_name))
-
-    # List the snapshots by time created
-    snapshots = get_snapshots_list(response, is_aurora)
-
-    # Sort snapshots by time and get all other than the latest one
-    if len(snapshots) > 1:
-        sorted_snapshots = sorted(snapshots.items(), key=operator.itemgetter(1), reverse=True)
-        snapshots_to_remove = [i[0] for i in sorted_snapshots[1:]]
-        print("Found {} snapshot(s) to remove".format(len(snapshots_to_remove)))
-
-        # Remove the snapshots
-        for snapshot in snapshots_to_remove:
-            print("Removing {}".format(snapshot))
-            if is_aurora:
-                TARGET_CLIENT.delete_db_cluster_snapshot(
-                    DBClusterSnapshotIdentifier=snapshot
-                )
-            else:
-                TARGET_CLIENT.delete_db_snapshot(
-                    DBSnapshotIdentifier=snapshot
-                )
+    if not_started:
+        print("No time left to back up {} of {} database(s): {}".format(
+            len(not_started), len(futures), ", ".join(not_started)))
+
+    if TRACK_COPIES:
+        report_copies(inventories, deadline)
+
+    return failures
+
+
+def get_event_messages(event):
+    """
+    Reads RDS event notifications from all records of Lambda event, sent by SNS directly or through SQS queue
+    :param event: dict Lambda event with SNS or SQS records
+    :return: Generator of tuples with SQS message ID (None for SNS) and dict with RDS event notification
+    """
+    for record in event["Records"]:
+        if "Sns" in record:
+            yield None, json.loads(record["Sns"]["Message"])
+        else:
+            body = json.loads(record["body"])
+            # SQS message is SNS notification with the RDS event inside, unless raw message delivery is enabled
+            yield record["messageId"], json.loads(body["Message"]) if "Message" in body else body
+
+
+def get_finished_backups(event):
+    """
+    Finds RDS instances with finished backups in all records of Lambda event, each instance only once
+    :param event: dict Lambda event with SNS or SQS records
+    :return: OrderedDict with instance names as keys and lists of IDs of SQS messages reporting them as values
+    """
+    instances = collections.OrderedDict()
+    notifications = 0
+    for message_id, message in get_event_messages(event):
+        # Check that event reports backup has finished
+        event_id = message["Event ID"].split("#")
+        if event_id[1] == "RDS-EVENT-0002":
+            notifications += 1
+            instances.setdefault(message["Source ID"], []).append(message_id)
+
+    print("Found {} finished backup(s) of {} database(s) in {} record(s)".format(
+        notifications, len(instances), len(event["Records"])))
+    return instances
+
+
+def get_copy_progress(snapshot, is_aurora, region, seconds):
+    """
+    Prints out progress of a single copy
+    :param snapshot: dict Copy details from describe call
+    :param is_aurora: bool True if it's Aurora cluster snapshot, False otherwise
+    :param region: string Target region of the copy
+    :param seconds: float How long the copy has been running (or took at most, if it's completed) or None if not known
+    :return: dict Progress of the copy
+    """
+    progress = {
+        "Snapshot": snapshot["DBClusterSnapshotIdentifier" if is_aurora else "DBSnapshotIdentifier"],
+        "Database": snapshot["DBClusterIdentifier" if is_aurora else "DBInstanceIdentifier"],
+        "Region": region,
+        "Completed": snapshot["Status"] == "available",
+        "PercentProgress": 100 if snapshot["Status"] == "available" else snapshot.get("PercentProgress", 0),
+        "Minutes": None,
+        "GBPerMinute": None,
+    }
+
+    if seconds is not None:
+        progress["Minutes"] = round(seconds / 60, 1)
+        if seconds > 0:
+            copied = snapshot.get("AllocatedStorage", 0) * progress["PercentProgress"] / 100.0
+            progress["GBPerMinute"] = round(copied / (seconds / 60), 2)
+
+    if progress["Completed"]:
+        print("Copy {Snapshot} of {Database} to {Region}: completed within {Minutes} minute(s), "
+              "{GBPerMinute} GB/min".format(**progress))
     else:
-        print("No old snapshots to remove in target region")
+        print("Copy {Snapshot} of {Database} to {Region}: {PercentProgress}% done after {Minutes} minute(s), "
+              "{GBPerMinute} GB/min".format(**progress))
+
+    return progress
+
+
+def report_copy_progress(inventory, deadline):
+    """
+    Prints out progress of copies which were in progress in target region, before or during this run. Snapshots in
+    target region are listed once more to get their current progress. Copies which finished since are reported with
+    their duration (at most, counted until now) and throughput.
+    :param inventory: TargetInventory of snapshots in target region, listed at the start of the run
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: List of dicts with progress of each copy
+    """
+    is_aurora = inventory.is_aurora
+    in_progress = inventory.get_in_progress()
+    if not in_progress:
+        return []
+
+    current = TargetInventory(inventory.region, is_aurora, deadline, inventory.instance_name)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    report = []
+    for snapshot in in_progress:
+        identifier = snapshot["DBClusterSnapshotIdentifier" if is_aurora else "DBSnapshotIdentifier"]
+        snapshot = current.get(identifier)
+        if snapshot is None:
+            print("Copy {} in {} is gone, it must have failed or been removed".format(identifier, inventory.region))
+            continue
+
+        # Snapshot creation time of a copy is the time when copying started
+        seconds = (now - snapshot["SnapshotCreateTime"]).total_seconds() if "SnapshotCreateTime" in snapshot else None
+        report.append(get_copy_progress(snapshot, is_aurora, inventory.region, seconds))
+
+    return report
+
+
+class CopyTracker(object):
+    """
+    Copies in progress in target regions, kept in SSM parameters - one for each copy, with the time it started.
+    Cross-region copies usually finish long after the run which started them, so each run checks all copies recorded
+    by the previous ones and reports those which finished since, with their duration and throughput.
+    """
+
+    def __init__(self, path, deadline):
+        """
+        :param path: string Path of SSM parameters, each named after target region and the copy
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        """
+        self.path = path.rstrip("/")
+        self.client = create_client("ssm", SOURCE_REGION, MAX_WORKERS * 2)
+        # Details of copies ("Started" timestamp and "Aurora" flag), by target region and snapshot identifier
+        self.copies = {}
+        self.added = set()
+        self.finished = set()
+
+        for _, response in get_pages(self.client.get_parameters_by_path, deadline, Path=self.path, Recursive=True):
+            for parameter in response["Parameters"]:
+                region, identifier = parameter["Name"][len(self.path) + 1:].split("/", 1)
+                self.copies[(region, identifier)] = json.loads(parameter["Value"])
+
+    def add(self, inventory):
+        """
+        Records copies in progress in target region which aren't recorded yet
+        :param inventory: TargetInventory of snapshots in target region
+        """
+        for snapshot in inventory.get_in_progress():
+            key = (inventory.region, snapshot["DBClusterSnapshotIdentifier" if inventory.is_aurora
+                                              else "DBSnapshotIdentifier"])
+            if key not in self.copies:
+                # Snapshot creation time of a copy is the time when copying started, copies started during this run
+                # may not have it yet
+                started = snapshot.get("SnapshotCreateTime")
+                self.copies[key] = {
+                    "Started": started.timestamp() if started else time.time(),
+                    "Aurora": inventory.is_aurora,
+                }
+                self.added.add(key)
+
+    def describe(self, region, is_aurora, identifiers, deadline):
+        """
+        Lists given copies in target region with a single (filtered) describe call
+        :param region: string Target region
+        :param is_aurora: bool True if copies are Aurora cluster snapshots, False for RDS instance snapshots
+        :param identifiers: List of names of the copies
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        :return: Dict with names of the copies as keys and their details as values (copies which are gone are missing)
+        """
+        if is_aurora:
+            function = get_rds_client(region).describe_db_cluster_snapshots
+            filter_name = "db-cluster-snapshot-id"
+            response_list_key = "DBClusterSnapshots"
+            identifier_key = "DBClusterSnapshotIdentifier"
+        else:
+            function = get_rds_client(region).describe_db_snapshots
+            filter_name = "db-snapshot-id"
+            response_list_key = "DBSnapshots"
+            identifier_key = "DBSnapshotIdentifier"
+
+        snapshots = {}
+        for _, response in get_pages(function, deadline, "Marker", SnapshotType="manual",
+                                     Filters=[{"Name": filter_name, "Values": identifiers}]):
+            for snapshot in response[response_list_key]:
+                snapshots[snapshot[identifier_key]] = snapshot
+
+        return snapshots
+
+    def report(self, deadline):
+        """
+        Checks all recorded copies, in all target regions at the same time, and prints out their progress. Copies which
+        finished are reported with their duration (at most, counted until now) and throughput, and no longer tracked.
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        :return: List of dicts with progress of each copy
+        """
+        groups = {}
+        for (region, identifier), copy in self.copies.items():
+            groups.setdefault((region, copy["Aurora"]), []).append(identifier)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(groups))) as executor:
+            futures = dict((group, executor.submit(self.describe, group[0], group[1], identifiers, deadline))
+                           for group, identifiers in groups.items())
+
+        now = time.time()
+        report = []
+        for (region, is_aurora), identifiers in groups.items():
+            snapshots = futures[(region, is_aurora)].result()
+            for identifier in identifiers:
+                snapshot = snapshots.get(identifier)
+                if snapshot is None or snapshot["Status"] not in ("pending", "creating", "copying", "available"):
+                    print("Copy {} in {} is gone or failed, it's no longer tracked".format(identifier, region))
+                    self.finished.add((region, identifier))
+                    continue
+
+                started = self.copies[(region, identifier)]["Started"]
+                progress = get_copy_progress(snapshot, is_aurora, region, now - started)
+                if progress["Completed"]:
+                    self.finished.add((region, identifier))
+                report.append(progress)
+
+        return report
+
+    def save(self, deadline):
+        """
+        Records new copies in their SSM parameters and removes parameters of copies which finished
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        """
+        for region, identifier in sorted(self.added - self.finished):
+            call_with_backoff(
+                self.client.put_parameter,
+                deadline,
+                Name="{}/{}/{}".format(self.path, region, identifier),
+                Value=json.dumps(self.copies[(region, identifier)]),
+                Type="String",
+                Overwrite=True
+            )
+
+        # Parameters of copies which finished during this run were never saved
+        names = ["{}/{}/{}".format(self.path, region, identifier)
+                 for region, identifier in sorted(self.finished - self.added)]
+        for start in range(0, len(names), 10):  # At most 10 parameters can be removed at once
+            call_with_backoff(self.client.delete_parameters, deadline, Names=names[start:start + 10])
+
+
+def report_copies(inventories, deadline):
+    """
+    Reports progress of copies in target regions, keeping track of them between runs if COPIES_PATH is set.
+    Failure to report doesn't fail the run.
+    :param inventories: Dict with target region as key and its TargetInventory as value
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    """
+    try:
+        if not COPIES_PATH:
+            for inventory in inventories.values():
+                report_copy_progress(inventory, deadline)
+            return
+
+        tracker = CopyTracker(COPIES_PATH, deadline)
+        for inventory in inventories.values():
+            tracker.add(inventory)
+        tracker.report(deadline)
+        tracker.save(deadline)
+    except Exception as e:
+        print("Reporting progress of copies failed: {}".format(e))
+
+
+class Watermarks(object):
+    """
+    Time of the latest snapshot copied to target region for each Aurora cluster, kept in SSM parameters - one for each
+    cluster, so the number of clusters isn't limited by the size of a single parameter.
+    Lets incremental runs skip clusters without new snapshots.
+    """
+
+    def __init__(self, path, deadline, cluster=None):
+        """
+        :param path: string Path of SSM parameters, each named after its cluster
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        :param cluster: string Name of the only cluster to load the watermark of, or None to load all of them
+        """
+        self.path = path.rstrip("/")
+        self.client = create_client("ssm", SOURCE_REGION, MAX_WORKERS * 2)
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.watermarks = {}
+
+        # Single cluster only needs its own parameter, no matter how many clusters there are
+        if cluster is not None:
+            try:
+                response = call_with_backoff(self.client.get_parameter, deadline,
+                                             Name="{}/{}".format(self.path, cluster))
+                self.watermarks[cluster] = float(response["Parameter"]["Value"])
+            except botocore.exceptions.ClientError as e:
+                # No snapshot of the cluster was copied yet
+                if e.response["Error"]["Code"] != "ParameterNotFound":
+                    raise e
+            return
+
+        for _, response in get_pages(self.client.get_parameters_by_path, deadline, Path=self.path):
+            for parameter in response["Parameters"]:
+                self.watermarks[parameter["Name"].rsplit("/", 1)[-1]] = float(parameter["Value"])
+
+    def is_new(self, cluster, snapshot):
+        """
+        :param cluster: string Name of the cluster
+        :param snapshot: Snapshot of the cluster
+        :return: True if snapshot is newer than the latest copied one
+        """
+        with self.lock:
+            return snapshot.create_time.timestamp() > self.watermarks.get(cluster, 0)
+
+    def update(self, cluster, snapshot):
+        """
+        Records snapshot as copied
+        :param cluster: string Name of the cluster
+        :param snapshot: Snapshot of the cluster
+        """
+        with self.lock:
+            if snapshot.create_time.timestamp() > self.watermarks.get(cluster, 0):
+                self.watermarks[cluster] = snapshot.create_time.timestamp()
+                self.changed.add(cluster)
+
+    def save(self, deadline):
+        """
+        Saves watermarks of clusters which changed in their SSM parameters
+        :param deadline: float Unix timestamp after which throttled calls are not retried
+        """
+        with self.lock:
+            changed = dict((cluster, self.watermarks[cluster]) for cluster in self.changed)
+
+        for cluster in sorted(changed):
+            call_with_backoff(
+                self.client.put_parameter,
+                deadline,
+                Name="{}/{}".format(self.path, cluster),
+                Value=str(changed[cluster]),
+                Type="String",
+                Overwrite=True
+            )
+            with self.lock:
+                self.changed.discard(cluster)
+
+
+def get_latest_cluster_snapshots(clusters_to_use, deadline):
+    """
+    Finds the latest automated snapshot of each Aurora cluster with a single (paginated) listing for the whole region.
+    :param clusters_to_use: List of cluster names or None for all clusters
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Dict with cluster name as key and its latest Snapshot as value
+    """
+    filters = []
+    if clusters_to_use:
+        filters.append({"Name": "db-cluster-id", "Values": clusters_to_use})
+
+    latest = {}
+    for _, response in get_pages(get_rds_client(SOURCE_REGION).describe_db_cluster_snapshots, deadline, "Marker",
+                                 SnapshotType="automated", Filters=filters):
+        for cluster_snapshot in response["DBClusterSnapshots"]:
+            if cluster_snapshot["Status"] != "available":
+                continue
+
+            cluster = cluster_snapshot["DBClusterIdentifier"]
+            snapshot = Snapshot.from_response(cluster_snapshot, True)
+            if cluster not in latest or snapshot.create_time > latest[cluster].create_time:
+                latest[cluster] = snapshot
+
+    return latest
+
+
+def backup_cluster(account_id, cluster, inventories, deadline, snapshot=None, watermarks=None):
+    """
+    Copies the latest snapshot of Aurora cluster to target regions and removes older copies.
+    :param account_id: int ID of the current AWS account
+    :param cluster: string Name of the cluster
+    :param inventories: Dict with target region as key and TargetInventory of cluster snapshots there as value
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :param snapshot: Snapshot The latest snapshot of the cluster, if already known
+    :param watermarks: Watermarks to record the copied snapshot in, if used
+    :return: None
+    """
+    if snapshot is None:
+        snapshot = get_latest_snapshot(cluster, True, deadline)
+    backup_snapshot(account_id, cluster, snapshot, True, inventories, deadline)
+
+    if watermarks is not None:
+        watermarks.update(cluster, snapshot)
+
+
+def backup_clusters(account_id, clusters, deadline, inventories=None, watermarks=None):
+    """
+    Backs up Aurora clusters, up to MAX_WORKERS at the same time. Failure of one cluster doesn't stop the others.
+    Each cluster is started as soon as it's found, without waiting for the full list.
+    :param account_id: int ID of the current AWS account
+    :param clusters: Iterable of (cluster name, its latest Snapshot or None if not known yet) tuples
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :param inventories: Dict with target region as key and TargetInventory of cluster snapshots there as value
+    or None to list them here
+    :param watermarks: Watermarks to record copied snapshots in, if used
+    :return: None
+    :raises Exception if no clusters were given or backup of any of the clusters failed
+    """
+    # List snapshots in target regions once for all clusters
+    if inventories is None:
+        inventories = get_inventories(True, deadline)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for cluster, snapshot in clusters:
+            futures[cluster] = executor.submit(backup_cluster, account_id, cluster, inventories, deadline, snapshot,
+                                               watermarks)
+
+    if len(futures) == 0:
+        raise Exception("No matching clusters found")
+
+    failures = []
+    for cluster, future in futures.items():
+        if future.exception() is not None:
+            print("Backup of cluster {} failed: {}".format(cluster, future.exception()))
+            failures.append("{}: {}".format(cluster, future.exception()))
+
+    if TRACK_COPIES:
+        report_copies(inventories, deadline)
+
+    if failures:
+        raise Exception("Backup failed for {} of {} cluster(s): {}".format(
+            len(failures), len(futures), "; ".join(failures)))
+
+
+def backup_clusters_incrementally(account_id, clusters_to_use, watermarks, deadline):
+    """
+    Backs up only Aurora clusters with automated snapshots newer than the ones already copied.
+    :param account_id: int ID of the current AWS account
+    :param clusters_to_use: List of cluster names or None for all clusters
+    :param watermarks: Watermarks with the latest copied snapshots
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    :raises Exception if no clusters were found or backup of any of the clusters failed
+    """
+    latest_snapshots = get_latest_cluster_snapshots(clusters_to_use, deadline)
+    if len(latest_snapshots) == 0:
+        raise Exception("No matching clusters found")
+
+    new_snapshots = [(cluster, snapshot) for cluster, snapshot in latest_snapshots.items()
+                     if watermarks.is_new(cluster, snapshot)]
+    print("Found new snapshots for {} of {} cluster(s)".format(len(new_snapshots), len(latest_snapshots)))
+    if len(new_snapshots) == 0:
+        return
+
+    try:
+        backup_clusters(account_id, new_snapshots, deadline, watermarks=watermarks)
+    except Exception:
+        # Still record clusters which were copied, without hiding why the others failed
+        try:
+            watermarks.save(deadline)
+        except Exception as e:
+            print("Failed to save watermarks: {}".format(e))
+        raise
+
+    watermarks.save(deadline)
+
+
+def backup_cluster_snapshot(account_id, snapshot_identifier, clusters_to_use, watermark_path, deadline):
+    """
+    Backs up Aurora cluster after EventBridge reported a new snapshot of it.
+    :param account_id: int ID of the current AWS account
+    :param snapshot_identifier: string Name or ARN of the new cluster snapshot
+    :param clusters_to_use: List of cluster names or None for all clusters
+    :param watermark_path: string Path of SSM parameters with watermarks or empty string if not used
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: None
+    """
+    response = call_with_backoff(
+        get_rds_client(SOURCE_REGION).describe_db_cluster_snapshots,
+        deadline,
+        DBClusterSnapshotIdentifier=snapshot_identifier
+    )
+    cluster_snapshot = response["DBClusterSnapshots"][0]
+    cluster = cluster_snapshot["DBClusterIdentifier"]
+
+    if cluster_snapshot["SnapshotType"] != "automated" or cluster_snapshot["Status"] != "available":
+        print("Snapshot {} is not a finished automated snapshot, skipping".format(snapshot_identifier))
+        return
+
+    if clusters_to_use and cluster not in clusters_to_use:
+        print("Cluster {} is not on the list of clusters to use, skipping".format(cluster))
+        return
+
+    snapshot = Snapshot.from_response(cluster_snapshot, True)
+    watermarks = Watermarks(watermark_path, deadline, cluster) if watermark_path else None
+    if watermarks is not None and not watermarks.is_new(cluster, snapshot):
+        print("Snapshot {} is not newer than the last one copied, skipping".format(snapshot_identifier))
+        return
+
+    inventories = get_inventories(True, deadline, cluster)
+    backup_cluster(account_id, cluster, inventories, deadline, snapshot, watermarks)
+    if watermarks is not None:
+        watermarks.save(deadline)
+
+    if TRACK_COPIES:
+        report_copies(inventories, deadline)
 
 
 def lambda_handler(event, context):
     account_id = context.invoked_function_arn.split(":")[4]
+    deadline = get_deadline(context)
+
+    clusters_to_use = os.environ.get("CLUSTERS_TO_USE", None)
+    if clusters_to_use:
+        clusters_to_use = clusters_to_use.split(",")
 
     # Scheduled event for Aurora
     if 'source' in event and event['source'] == "aws.events":
-        clusters_to_use = os.environ.get("CLUSTERS_TO_USE", None)
-        if clusters_to_use:
-            clusters_to_use = clusters_to_use.split(",")
-        clusters = get_clusters(clusters_to_use)
+        if WATERMARK_PATH:
+            backup_clusters_incrementally(account_id, clusters_to_use, Watermarks(WATERMARK_PATH, deadline), deadline)
+        else:
+            clusters = ((cluster, None) for cluster in get_clusters(clusters_to_use, deadline))
+            backup_clusters(account_id, clusters, deadline)
 
-        if len(clusters) == 0:
-            raise Exception("No matching clusters found")
+    # EventBridge event about new Aurora cluster snapshot
+    elif 'source' in event and event['source'] == "aws.rds":
+        backup_cluster_snapshot(account_id, event["detail"]["SourceArn"], clusters_to_use, WATERMARK_PATH, deadline)
 
-        for cluster in clusters:
-            copy_latest_snapshot(account_id, cluster, True)
-            remove_old_snapshots(cluster, True)
+    else:  # Assume SNS (directly or through SQS queue) about instance backups
+        instances = get_finished_backups(event)
+        failures = backup_instances(account_id, list(instances), deadline) if instances else {}
 
-    else:  # Assume SNS about instance backup
-        message = json.loads(event["Records"][0]["Sns"]["Message"])
+        # Only messages about databases which failed go back to the queue (and to dead-letter queue in the end)
+        if any(record.get("eventSource") == "aws:sqs" for record in event["Records"]):
+            return {"batchItemFailures": [{"itemIdentifier": message_id}
+                                          for instance_name in failures for message_id in instances[instance_name]]}
 
-        # Check that event reports backup has finished
-        event_id = message["Event ID"].split("#")
-        if event_id[1] == "RDS-EVENT-0002":
-            copy_latest_snapshot(account_id, message["Source ID"], False)
-            remove_old_snapshots(message["Source ID"], False)
+        if failures:
+            raise Exception("Backup failed for {} of {} database(s): {}".format(
+                len(failures), len(instances), "; ".join(
+                    "{}: {}".format(instance_name, error) for instance_name, error in failures.items())))
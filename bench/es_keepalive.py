@@ -0,0 +1,144 @@
+"""
+Measures requests per second of clean-es-indices.py against a local HTTPS stand-in for ElasticSearch (with keep-alive
+enabled, like the real service): listing indices and removing them one by one, once with a new connection for every
+request (as before) and once with the keep-alive connection reused by all requests.
+
+clean-es-indices.py runs on Python 2.7, so this does too. Requires openssl to create a temporary certificate.
+
+Usage: python2.7 bench/es_keepalive.py [number of indices to remove, default 200]
+"""
+import imp
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Signing requests needs credentials, but they're not checked by the stand-in
+ENV = {
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_SESSION_TOKEN": "testing",
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers like ElasticSearch: _cat/indices lists the indices, DELETE acknowledges removal
+    """
+    protocol_version = "HTTP/1.1"
+    # Send each response with a single write, so it isn't held back waiting for client's ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    indices = []
+
+    def respond(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond("".join("{} {} {}\n".format(index, 1500000000000 + position, 1024)
+                             for position, index in enumerate(self.indices)))
+
+    def do_DELETE(self):
+        self.respond('{"acknowledged":true}')
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Closing connections without TLS shutdown, as clients do, isn't worth reporting
+        pass
+
+
+def start_server(directory, indices):
+    """
+    Starts HTTPS stand-in on a free local port, in a background thread
+    :param directory: string Directory to create the certificate in
+    :param indices: list Names of indices to list
+    :return: StandInServer
+    """
+    certificate = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                               "-subj", "/CN=localhost", "-keyout", key, "-out", certificate],
+                              stdout=devnull, stderr=devnull)
+
+    StandInHandler.indices = indices
+    server = StandInServer(("localhost", 0), StandInHandler)
+    server.socket = ssl.wrap_socket(server.socket, keyfile=key, certfile=certificate, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def load_module():
+    """
+    Loads clean-es-indices.py, which can't be imported by name because of the dashes
+    :return: module
+    """
+    return imp.load_source("clean_es_indices", os.path.join(ROOT, "clean-es-indices.py"))
+
+
+def run(module, endpoint, keep_alive):
+    """
+    Lists indices and removes each of them with a separate request
+    :param module: clean-es-indices module
+    :param endpoint: string Host and port of the stand-in
+    :param keep_alive: bool True to reuse one connection, False to open a new one for every request (as before)
+    :return: Tuple of number of requests and seconds they took
+    """
+    connection = module.EsConnection(endpoint)
+    start = time.time()
+    indices = [index.name for index in module.get_index_list(connection)]
+    requests = 1
+    for index in indices:
+        if not keep_alive:
+            connection.close()
+        module.delete_index(connection, index)
+        requests += 1
+    connection.close()
+    return requests, time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    os.environ.update(ENV)
+    # The stand-in's certificate is self-signed
+    ssl._create_default_https_context = ssl._create_unverified_context
+
+    sys.dont_write_bytecode = True
+    module = load_module()
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_server(directory, ["cwl-{:04d}".format(index) for index in range(count)])
+        endpoint = "localhost:{}".format(server.server_address[1])
+
+        print("{:<25} {:>10} {:>10} {:>14}".format("connection", "requests", "seconds", "requests/s"))
+        for name, keep_alive in (("new for every request", False), ("keep-alive", True)):
+            requests, seconds = run(module, endpoint, keep_alive)
+            print("{:<25} {:>10} {:>10.2f} {:>14.1f}".format(name, requests, seconds, requests / seconds))
+
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
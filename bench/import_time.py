@@ -0,0 +1,70 @@
+"""
+Measures cold start cost of the Lambdas: time to import each module and to create its first client, each run in
+a fresh Python process (like a new Lambda container).
+
+Usage: python bench/import_time.py [number of runs, default 10]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module file and code creating its first client, as done on the first invocation
+MODULES = [
+    ("backup-rds.py", "module.get_rds_client(module.SOURCE_REGION)"),
+    ("ebs-snapshots.py", "module.get_ec2_client('eu-west-1')"),
+]
+
+# Run in the child process, prints timings in milliseconds as JSON
+CHILD = """
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("module", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+{client}
+created = time.perf_counter()
+print(json.dumps({{"import": (imported - start) * 1000, "client": (created - imported) * 1000}}))
+"""
+
+# Enough configuration for the modules to load, no AWS credentials are needed to create clients
+ENV = {
+    "AWS_DEFAULT_REGION": "eu-west-1",
+    "SOURCE_REGION": "eu-west-1",
+    "TARGET_REGIONS": "eu-central-1",
+}
+
+
+def measure(filename, client_code):
+    """
+    Imports the module and creates its first client in a new process
+    :param filename: string Name of the Lambda file
+    :param client_code: string Python code creating the first client
+    :return: dict Milliseconds spent on "import" and "client"
+    """
+    # Shared aws_calls module is imported from the same directory, like in the Lambda's zip
+    env = dict(os.environ, PYTHONPATH=ROOT, **ENV)
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD.format(client=client_code), os.path.join(ROOT, filename)], env=env
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("{:<20} {:>12} {:>12} {:>12}".format("module", "import ms", "client ms", "total ms"))
+    for filename, client_code in MODULES:
+        timings = [measure(filename, client_code) for _ in range(runs)]
+        import_ms = statistics.median(timing["import"] for timing in timings)
+        client_ms = statistics.median(timing["client"] for timing in timings)
+        print("{:<20} {:>12.1f} {:>12.1f} {:>12.1f}".format(filename, import_ms, client_ms, import_ms + client_ms))
+
+    print("Medians of {} run(s), each in a new process".format(runs))
+
+
+if __name__ == "__main__":
+    main()
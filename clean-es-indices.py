@@ -2,8 +2,12 @@ import os
 import datetime
 import hashlib
 import hmac
-import urllib2
-import json
+import httplib
+import socket
+import threading
+import time
+from collections import namedtuple
+from urllib import quote
 
 ENDPOINTS_ACCOUNTS = {
     'account-1': 'elastic-search-endpoint',
@@ -15,6 +19,31 @@ THRESHOLD_ACCOUNTS = {
     'account-2': 60
 }
 
+# Optional: maximum total size in bytes (including replicas) of indices to keep,
+# for example 'account-1': 100 * 1024 ** 3. The newest indices are kept until the size is reached,
+# together with the limit from THRESHOLD_ACCOUNTS (if any)
+BYTES_ACCOUNTS = {
+}
+
+# Prefix of indices to clean up
+INDEX_PREFIX = 'cwl-'
+
+# Seconds to wait for ElasticSearch to respond
+TIMEOUT = 30
+
+# Seconds before Lambda timeout to stop sending new requests
+DEADLINE_MARGIN = 5
+
+# Maximum length of the path in a request deleting many indices at once (ElasticSearch limits the request line to 4kB)
+MAX_URL_LENGTH = 3500
+
+# Keep-alive connections, by endpoint
+CONNECTIONS = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+# Index details from _cat/indices: name, size on disk in bytes and creation time in milliseconds since epoch
+Index = namedtuple('Index', ['name', 'size', 'created'])
+
 
 def sign(key, msg):
     return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
@@ -28,7 +57,7 @@ def getSignatureKey(key, dateStamp, regionName, serviceName):
     return kSigning
 
 
-def get_signature(endpoint, method, canonical_uri):
+def get_signature(endpoint, method, uri, query=None):
     region = 'eu-west-1'
     service = 'es'
     access_key = os.environ.get('AWS_ACCESS_KEY_ID')
@@ -37,7 +66,9 @@ def get_signature(endpoint, method, canonical_uri):
     t = datetime.datetime.utcnow()
     amzdate = t.strftime('%Y%m%dT%H%M%SZ')
     datestamp = t.strftime('%Y%m%d')
-    canonical_querystring = ''
+    canonical_uri = quote(uri, safe='/~')
+    canonical_querystring = '&'.join(quote(key, safe='~') + '=' + quote(value, safe='~')
+                                     for key, value in sorted((query or {}).items()))
     canonical_headers = 'host:' + endpoint + '\nx-amz-date:' + amzdate + '\nx-amz-security-token:' + session_key + "\n"
     signed_headers = 'host;x-amz-date;x-amz-security-token'
     payload_hash = hashlib.sha256('').hexdigest()
@@ -50,56 +81,258 @@ def get_signature(endpoint, method, canonical_uri):
     signature = hmac.new(signing_key, (string_to_sign).encode('utf-8'), hashlib.sha256).hexdigest()
     authorization_header = algorithm + ' ' + 'Credential=' + access_key + '/' + credential_scope + ', ' + 'SignedHeaders=' + signed_headers + ', ' + 'Signature=' + signature
     headers = {'x-amz-date': amzdate, 'x-amz-security-token': session_key, 'Authorization': authorization_header}
-    request_url = 'https://' + endpoint + canonical_uri + '?' + canonical_querystring
+    request_path = uri + ('?' + canonical_querystring if canonical_querystring else '')
+    request_url = 'https://' + endpoint + request_path
+
+    return {'url': request_url, 'path': request_path, 'headers': headers}
+
+
+class EsConnection(object):
+    """
+    Keep-alive HTTPS connection to ElasticSearch endpoint, reused by all requests to that endpoint
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.connection = None
+
+    def open(self, method, uri, query=None):
+        # Returns the response, which needs to be read completely before the next request
+        info = get_signature(self.endpoint, method, uri, query)
+
+        # Reconnect once if the connection was closed since the last request (ES closes idle connections)
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPSConnection(self.endpoint, timeout=TIMEOUT)
 
-    return {'url': request_url, 'headers': headers}
+            try:
+                self.connection.request(method, info['path'], headers=info['headers'])
+                response = self.connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt == 1:
+                    raise
+
+        if response.status != 200:
+            response.read()
+            raise Exception("Non 200 response when calling, got: " + str(response.status))
+
+        return response
+
+    def request(self, method, uri, query=None):
+        return self.open(method, uri, query).read()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def get_connection(endpoint):
+    with CONNECTIONS_LOCK:
+        if endpoint not in CONNECTIONS:
+            CONNECTIONS[endpoint] = EsConnection(endpoint)
+
+        return CONNECTIONS[endpoint]
 
 
 def lambda_handler(event, context):
-    INDEXPREFIX = 'cwl-'
-
-    if 'account' in event:
-        if event['account'] not in ENDPOINTS_ACCOUNTS.keys():
-            raise Exception("No endpoint configured for account " + str(event['account']))
-        ENDPOINT = ENDPOINTS_ACCOUNTS[event['account']]
-        TOLEAVE = THRESHOLD_ACCOUNTS[event['account']]
-    else:
-        raise Exception("No account specified in event")
-
-    response = json.loads(get_index_list(ENDPOINT))
-    indexes = []
-    for index in response:
-        if index.startswith(INDEXPREFIX):
-            indexes.append(index)
+    # With {"accounts": "all"} in the event, all accounts are cleaned, each endpoint at the same time.
+    # Scheduled events always have "account" (AWS account id), so it has to be set in the rule's constant input.
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN if context else None
+
+    if event.get('accounts') != 'all':
+        if 'account' not in event:
+            raise Exception("No account specified in event")
+        summary = clean_account(event['account'], deadline)
+        if summary['failed']:
+            raise Exception(get_failure_message(summary))
+        return summary
+
+    summaries = clean_all_accounts(deadline)
+    failures = []
+    for account in sorted(summaries):
+        summary = summaries[account]
+        print(account + " (" + summary['endpoint'] + "): " + (summary.get('error') or (
+            str(summary['kept']) + " kept, " + str(summary['removed']) + " removed, " +
+            str(len(summary['failed'])) + " failed, " + str(summary['skipped']) + " left for next run")))
+        if 'error' in summary:
+            failures.append(account + ": " + summary['error'])
+        elif summary['failed']:
+            failures.append(account + ": " + get_failure_message(summary))
+
+    if failures:
+        raise Exception("Cleaning failed for " + str(len(failures)) + " of " + str(len(summaries)) + " accounts: " +
+                        "; ".join(failures))
+
+    return summaries
+
+
+def clean_account(account, deadline):
+    # Removes old indices of the account and returns a summary of what was done
+    if account not in ENDPOINTS_ACCOUNTS.keys():
+        raise Exception("No endpoint configured for account " + str(account))
+    ENDPOINT = ENDPOINTS_ACCOUNTS[account]
+    TOLEAVE = THRESHOLD_ACCOUNTS.get(account)
+    MAXBYTES = BYTES_ACCOUNTS.get(account)
+    if TOLEAVE is None and MAXBYTES is None:
+        raise Exception("No threshold configured for account " + str(account))
 
+    connection = get_connection(ENDPOINT)
+    indexes = list(get_index_list(connection))
+
+    # Newest first (by name)
     indexes.sort(reverse=True)
-    to_remove = indexes[TOLEAVE:]
-    for index in to_remove:
-        print("Removing " + index)
-        delete_index(ENDPOINT, index)
+    to_remove = get_indices_to_remove(indexes, TOLEAVE, MAXBYTES)
+    print("Keeping " + str(len(indexes) - len(to_remove)) + " indices (" +
+          str(sum(index.size for index in indexes[:len(indexes) - len(to_remove)])) + " bytes), removing " +
+          str(len(to_remove)) + " (" + str(sum(index.size for index in to_remove)) + " bytes) for " + account)
+    failures, skipped = delete_indices(connection, [index.name for index in to_remove], deadline)
+
+    return {
+        'endpoint': ENDPOINT,
+        'kept': len(indexes) - len(to_remove),
+        'removed': len(to_remove) - len(failures) - len(skipped),
+        'failed': failures,
+        'skipped': len(skipped),
+    }
+
+
+def clean_endpoint_accounts(endpoint, accounts, deadline, summaries):
+    # Cleans accounts sharing the endpoint one by one, as they share its connection
+    for account in accounts:
+        try:
+            summaries[account] = clean_account(account, deadline)
+        except Exception as e:
+            print("Cleaning " + account + " failed: " + str(e))
+            summaries[account] = {'endpoint': endpoint, 'error': str(e)}
+            get_connection(endpoint).close()
+
+
+def clean_all_accounts(deadline):
+    # Cleans all accounts from ENDPOINTS_ACCOUNTS, each endpoint in its own thread, so one can't stop the others
+    accounts_by_endpoint = {}
+    for account in sorted(ENDPOINTS_ACCOUNTS):
+        accounts_by_endpoint.setdefault(ENDPOINTS_ACCOUNTS[account], []).append(account)
+
+    summaries = {}
+    threads = [threading.Thread(target=clean_endpoint_accounts, args=(endpoint, accounts, deadline, summaries))
+               for endpoint, accounts in accounts_by_endpoint.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summaries
+
+
+def get_failure_message(summary):
+    return "Failed to remove " + str(len(summary['failed'])) + " of " + str(
+        len(summary['failed']) + summary['removed'] + summary['skipped']) + " indices: " + ", ".join(summary['failed'])
+
+
+def get_indices_to_remove(indexes, to_leave, max_bytes):
+    # Keeps up to to_leave newest indices, as long as their total size is within max_bytes (None for no limit)
+    total_size = 0
+    for position, index in enumerate(indexes):
+        total_size += index.size
+        if to_leave is not None and position >= to_leave:
+            return indexes[position:]
+
+        # The newest index is always kept, even if it's bigger than the limit alone
+        if max_bytes is not None and position > 0 and total_size > max_bytes:
+            return indexes[position:]
+
+    return []
+
+
+def delete_index(connection, index):
+    connection.request('DELETE', '/' + index)
+
+
+def get_chunks(indices, max_length):
+    # Groups indices, so that each group joined with commas fits in max_length
+    chunk = []
+    length = 0
+    for index in indices:
+        if chunk and length + 1 + len(index) > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+
+        length += len(index) + (1 if chunk else 0)
+        chunk.append(index)
+
+    if chunk:
+        yield chunk
+
+
+def delete_indices(connection, indices, deadline=None):
+    # Deletes many indices with one request, falling back to one request per index if that fails.
+    # Returns indices that failed and those left for the next run, as the deadline was reached
+    failures = []
+    skipped = []
+    for chunk in get_chunks(indices, MAX_URL_LENGTH - 1):
+        if deadline is not None and time.time() > deadline:
+            skipped.extend(chunk)
+            continue
+
+        print("Removing " + ", ".join(chunk))
+        try:
+            delete_index(connection, ",".join(chunk))
+            continue
+        except Exception as e:
+            if len(chunk) == 1:
+                print("Failed to remove " + chunk[0] + ": " + str(e))
+                failures.append(chunk[0])
+                continue
+
+            print("Failed to remove " + str(len(chunk)) + " indices at once, removing one by one: " + str(e))
+
+        for index in chunk:
+            if deadline is not None and time.time() > deadline:
+                skipped.append(index)
+                continue
+
+            try:
+                delete_index(connection, index)
+            except Exception as e:
+                print("Failed to remove " + index + ": " + str(e))
+                failures.append(index)
+
+    if skipped:
+        print("Not enough time left, " + str(len(skipped)) + " indices left for the next run")
 
+    return failures, skipped
 
-def delete_index(endpoint, index):
-    info = get_signature(endpoint, 'DELETE', '/' + index)
 
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request(info['url'], headers=info['headers'])
-    request.get_method = lambda: 'DELETE'
+def read_lines(response):
+    # Reads the response line by line, without keeping all of it in memory
+    buffered = ''
+    while True:
+        data = response.read(8192)
+        if not data:
+            break
 
-    r = opener.open(request)
-    if r.getcode() != 200:
-        raise Exception("Non 200 response when calling, got: " + str(r.getcode()))
+        lines = (buffered + data).split('\n')
+        buffered = lines.pop()
+        for line in lines:
+            yield line
 
+    if buffered:
+        yield buffered
 
-def get_index_list(endpoint):
-    info = get_signature(endpoint, 'GET', '/_aliases')
 
-    request = urllib2.Request(info['url'], headers=info['headers'])
-    r = urllib2.urlopen(request)
-    if r.getcode() != 200:
-        raise Exception("Non 200 response when calling, got: " + str(r.getcode()))
+def get_index_list(connection):
+    # Only indices matching the prefix are listed, with sizes in bytes (empty for closed indices)
+    response = connection.open('GET', '/_cat/indices/' + INDEX_PREFIX + '*',
+                               {'h': 'index,creation.date,store.size', 'bytes': 'b'})
 
-    return r.read()
+    for line in read_lines(response):
+        fields = line.split()
+        if fields:
+            yield Index(fields[0], int(fields[2]) if len(fields) > 2 else 0, int(fields[1]))
 
 
 if __name__ == '__main__':
@@ -20,20 +20,58 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
 import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
 
-EC2_CLIENT = boto3.client("ec2")
-EC2_RESOURCE = boto3.resource("ec2")
-TODAY = datetime.date.today()
+from aws_calls import (MAX_RETRIES, THROTTLING_ERRORS, call_with_backoff, create_client, get_deadline, get_error_code,
+                       get_pages, is_retryable)
 
+# List of regions to backup, leave empty to only use the region Lambda runs in
+REGIONS = []
 # How long to keep backups for by default
 DEFAULT_RETENTION = 7
 # Name of the tag indicating which instances to backup
 BACKUP_TAG = "Backup"
 # Name of the tag indicating deletion date for snapshots
 DELETE_ON_TAG = "DeleteOn"
+# How many instances to snapshot in parallel
+MAX_WORKERS = 10
+# How many snapshots to delete in parallel
+DELETE_WORKERS = 10
+# Maximum number of snapshot deletions per second
+DELETE_RATE = 5
+# How many days back to look for expired DeleteOn dates (at most 200 - EC2 limit of filter values)
+EXPIRY_LOOKBACK_DAYS = 30
+# Every how many days to list all snapshots with DeleteOn tag, to catch those older than EXPIRY_LOOKBACK_DAYS
+FULL_SCAN_INTERVAL = 7
+# Part of the execution time reserved for creating snapshots, the rest is left for removing old ones
+CREATE_TIME_SHARE = 0.5
+# How many times Lambda can invoke itself to continue unfinished work, before leaving it for the next scheduled run
+MAX_CONTINUATIONS = 3
+
+# EC2 clients, by region
+EC2_CLIENTS = {}
+EC2_CLIENTS_LOCK = threading.Lock()
+
+
+def get_ec2_client(region):
+    """
+    Returns EC2 client for the region, creating it on first use
+    :param region: string Name of the region or None for the region Lambda runs in
+    :return: boto3 EC2 client
+    """
+    with EC2_CLIENTS_LOCK:
+        if region not in EC2_CLIENTS:
+            EC2_CLIENTS[region] = create_client("ec2", region, max(MAX_WORKERS, DELETE_WORKERS))
+
+        return EC2_CLIENTS[region]
 
 
 def get_retention_period(instance):
@@ -68,110 +106,586 @@ def find_delete_tag(tags):
     return delete_date
 
 
-def is_already_snapshoted(volume):
+def get_snapshoted_volumes(ec2_client, today, deadline):
     """
-    Check is volume already had snapshot created by us today
-    :param volume: ec2.Volume object from boto3 for the volume in question
-    :return: True/False whether the snapshot exists
+    Finds volumes that already had a snapshot created by us today, using a single paginated scan of today's snapshots
+    :param ec2_client: boto3 EC2 client for the region
+    :param today: datetime.date Date of this run
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Set of volume ids with today's snapshot
     """
-    snapshots = volume.snapshots.all()
-    for snapshot in snapshots:
-        if snapshot.start_time.date() == TODAY and snapshot.state in ("pending", "completed") and \
-                find_delete_tag(snapshot.tags) is not None:
-            return True
+    volumes = set()
+
+    response_iterator = get_pages(
+        ec2_client.describe_snapshots,
+        deadline,
+        OwnerIds=["self"],
+        Filters=[
+            {"Name": "tag-key", "Values": [DELETE_ON_TAG]},
+            {"Name": "status", "Values": ["pending", "completed"]},
+            # Only snapshots started today (in UTC, like StartTime), instead of all our snapshots
+            {"Name": "start-time", "Values": [today.isoformat() + "*"]},
+        ],
+        MaxResults=1000,
+    )
+
+    for _, snapshots in response_iterator:
+        for snapshot in snapshots["Snapshots"]:
+            if snapshot["StartTime"].date() == today:
+                volumes.add(snapshot["VolumeId"])
 
-    return False
+    return volumes
 
 
-def create_snapshots(context):
+class SnapshotPlan(object):
     """
-    Find instances to backup and create their snapshots
-    :param context: Lambda context object
+    Everything needed to snapshot a single instance, worked out once from describe_instances output
     """
-    paginator = EC2_CLIENT.get_paginator("describe_instances")
+    __slots__ = ("instance_id", "retention_days", "delete_date", "tags", "exclude_boot_volume",
+                 "excluded_data_volumes")
+
+    def __init__(self, instance, done_volumes, created_by, today):
+        """
+        :param instance: dict Dictionary output with instance details from describe_instances call
+        :param done_volumes: list IDs of volumes of this instance that already have a snapshot from today
+        :param created_by: string Name of this Lambda function, added as CreatedBy tag
+        :param today: datetime.date Date of this run
+        """
+        self.instance_id = instance["InstanceId"]
+
+        # Get how many days we should keep this snapshot for and find date when to delete
+        self.retention_days = get_retention_period(instance)
+        self.delete_date = today + datetime.timedelta(days=self.retention_days)
 
-    response_iterator = paginator.paginate(
+        # Copy instance tags without the "backup" tag (and reserved "aws:" tags, which can't be set on snapshots),
+        # add the deletion date and function name for reference who created the snapshot
+        self.tags = tuple(
+            [tag for tag in instance["Tags"] if tag["Key"] != BACKUP_TAG and not tag["Key"].startswith("aws:")] + [
+                {"Key": DELETE_ON_TAG, "Value": self.delete_date.strftime("%Y-%m-%d")},
+                {"Key": "CreatedBy", "Value": created_by},
+            ]
+        )
+
+        root_volumes = [device["Ebs"]["VolumeId"] for device in instance["BlockDeviceMappings"]
+                        if "Ebs" in device and device["DeviceName"] == instance.get("RootDeviceName")]
+        self.exclude_boot_volume = any(volume_id in done_volumes for volume_id in root_volumes)
+        self.excluded_data_volumes = tuple(volume_id for volume_id in done_volumes if volume_id not in root_volumes)
+
+
+def find_instances_to_snapshot(ec2_client, cursor, created_by, today, deadline):
+    """
+    Walks through tagged instances and yields those with EBS volumes that don't have a snapshot from today yet
+    :param ec2_client: boto3 EC2 client for the region
+    :param cursor: dict Position saved by previous run (NextToken and LastInstanceId) or None to start from the
+    beginning
+    :param created_by: string Name of this Lambda function, added as CreatedBy tag
+    :param today: datetime.date Date of this run
+    :param deadline: float Unix timestamp after which throttled calls are not retried
+    :return: Generator of (page token, SnapshotPlan) tuples, where page token is the token needed to fetch
+    the instance's page again
+    """
+    cursor = cursor or {}
+
+    # Check which volumes already have snapshots from today once, instead of per volume
+    snapshoted_volumes = get_snapshoted_volumes(ec2_client, today, deadline)
+
+    response_iterator = get_pages(
+        ec2_client.describe_instances,
+        deadline,
         Filters=[
             {"Name": "tag-key", "Values": [BACKUP_TAG]},
+        ],
+        NextToken=cursor.get("NextToken"),
+    )
+
+    # Instances up to this one (on the first page) were already processed by previous run
+    last_instance_id = cursor.get("LastInstanceId")
+    for page_token, instances in response_iterator:
+        page_instances = [instance for reservations in instances["Reservations"]
+                          for instance in reservations["Instances"]]
+        instance_ids = [instance["InstanceId"] for instance in page_instances]
+        if last_instance_id in instance_ids:
+            page_instances = page_instances[instance_ids.index(last_instance_id) + 1:]
+        last_instance_id = None
+
+        for instance in page_instances:
+            done_volumes = []
+            has_new_volumes = False
+            for device in instance["BlockDeviceMappings"]:
+                # Look at every EBS volume attached to this instance
+                if "Ebs" in device:
+                    volume_id = device["Ebs"]["VolumeId"]
+                    if volume_id in snapshoted_volumes:
+                        print("Already done today: volume {} on instance {}, skipping".format(volume_id, instance[
+                            "InstanceId"]))
+                        done_volumes.append(volume_id)
+                        continue
+
+                    print("Found EBS volume {} on instance {}".format(volume_id, instance["InstanceId"]))
+                    has_new_volumes = True
+
+            if has_new_volumes:
+                yield page_token, SnapshotPlan(instance, done_volumes, created_by, today)
+
+
+def snapshot_instance(ec2_client, plan, deadline):
+    """
+    Creates tagged snapshots of all volumes of a single instance (except those already done) with one API call
+    :param ec2_client: boto3 EC2 client for the region
+    :param plan: SnapshotPlan for the instance
+    :param deadline: float Unix timestamp after which the instance is skipped
+    :return: True if snapshots were created, False if instance was skipped due to deadline
+    """
+    if time.time() > deadline:
+        return False
+
+    # Skip volumes that are already done - boot volume can only be excluded with a separate flag
+    instance_specification = {
+        "InstanceId": plan.instance_id,
+        "ExcludeBootVolume": plan.exclude_boot_volume,
+    }
+    if plan.excluded_data_volumes:
+        instance_specification["ExcludeDataVolumeIds"] = list(plan.excluded_data_volumes)
+
+    # Create the snapshots, with all the tags applied straight away
+    response = call_with_backoff(
+        ec2_client.create_snapshots,
+        deadline,
+        InstanceSpecification=instance_specification,
+        Description="Snapshot from instance {}".format(plan.instance_id),
+        TagSpecifications=[
+            {
+                "ResourceType": "snapshot",
+                "Tags": list(plan.tags)
+            }
         ]
     )
 
-    for instances in response_iterator:
-        for reservations in instances["Reservations"]:
-            for instance in reservations["Instances"]:
-                for device in instance["BlockDeviceMappings"]:
-                    # Look at every EBS volume attached to this instance
-                    if "Ebs" in device:
-                        # Get volume and check if snapshot already exists
-                        volume = EC2_RESOURCE.Volume(device["Ebs"]["VolumeId"])
-                        if is_already_snapshoted(volume):
-                            print("Already done today: volume {} on instance {}, skipping".format(volume.id, instance[
-                                "InstanceId"]))
-                            continue
-
-                        print("Found EBS volume {} on instance {}".format(volume.id, instance["InstanceId"]))
-
-                        # Create the snapshot
-                        snapshot = volume.create_snapshot(
-                            Description="Snapshot from instance {}".format(instance["InstanceId"])
-                        )
-
-                        # Get how many days we should keep this snapshot for
-                        retention_days = get_retention_period(instance)
-
-                        # Get instance tags and remove the "backup" tag
-                        tags = instance["Tags"]
-                        for tag in tags:
-                            if tag["Key"] == BACKUP_TAG:
-                                tags.remove(tag)
-                                break
-
-                        # Find date when to delete and add the tag to the list
-                        delete_date = datetime.date.today() + datetime.timedelta(days=retention_days)
-                        tags.append(
-                            {
-                                "Key": DELETE_ON_TAG,
-                                "Value": delete_date.strftime("%Y-%m-%d")
-                            }
-                        )
-                        # Add function name to the tags for reference who created the snapshot
-                        tags.append(
-                            {
-                                "Key": "CreatedBy",
-                                "Value": context.function_name
-                            }
-                        )
-
-                        # Apply all those tags to the snapshot
-                        snapshot.create_tags(Tags=tags)
-
-                        print("Retaining snapshot {} of volume {} from instance {} until {}".format(
-                            snapshot.id, volume.id, instance["InstanceId"], delete_date
-                        ))
-
-
-def remove_snapshots():
-    """
-    Find our old snapshots and remove as needed (when DeleteOn is today or earlier)
-    """
-    paginator = EC2_CLIENT.get_paginator("describe_snapshots")
-    response_iterator = paginator.paginate(
-        Filters=[
+    for snapshot in response["Snapshots"]:
+        print("Retaining snapshot {} of volume {} from instance {} until {}".format(
+            snapshot["SnapshotId"], snapshot["VolumeId"], plan.instance_id, plan.delete_date
+        ))
+
+    return True
+
+
+def create_snapshots(ec2_client, context, deadline, cursor, today):
+    """
+    Find instances to backup and create their snapshots, using up to MAX_WORKERS parallel workers
+    :param ec2_client: boto3 EC2 client for the region
+    :param context: Lambda context object
+    :param deadline: float Unix timestamp after which no more snapshots are created
+    :param cursor: dict Position saved by previous run or None to start from the beginning
+    :param today: datetime.date Date of this run
+    :return: Tuple of position to continue from in the next run (None if all instances were processed)
+    and list of errors from instances that failed (or from listing them)
+    """
+    # Position (page token and instance id) of each instance submitted for snapshots, in order
+    positions = []
+    futures = []
+    stopped_at = None
+    errors = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            for page_token, plan in find_instances_to_snapshot(ec2_client, cursor, context.function_name, today,
+                                                               deadline):
+                positions.append((page_token, plan.instance_id))
+                if time.time() > deadline:
+                    stopped_at = len(positions) - 1
+                    break
+
+                futures.append(executor.submit(
+                    snapshot_instance, ec2_client, plan, deadline
+                ))
+        except Exception as e:
+            print("Finding instances to snapshot failed: {}".format(e))
+            errors.append(e)
+            # Only continue after the last instance found if listing can work next time (like when still throttled
+            # at the deadline), not when it failed for good (like missing permissions)
+            if is_retryable(e) or time.time() > deadline:
+                stopped_at = len(positions)
+
+    skipped = []
+    for index, future in enumerate(futures):
+        if future.exception() is not None:
+            errors.append(future.exception())
+        elif not future.result():
+            skipped.append(index)
+
+    if skipped:
+        stopped_at = min(skipped)
+
+    if stopped_at is None:
+        return None, errors
+
+    # Continue from the page of first instance not processed, right after the instance processed before it
+    if stopped_at > 0:
+        previous_token, previous_instance_id = positions[stopped_at - 1]
+    else:
+        previous_token, previous_instance_id = (cursor or {}).get("NextToken"), (cursor or {}).get("LastInstanceId")
+
+    # Listing failed before the next instance was found, so continue from the page of the one before it
+    page_token, _ = positions[stopped_at] if stopped_at < len(positions) else (previous_token, None)
+    return {
+        "NextToken": page_token,
+        "LastInstanceId": previous_instance_id if previous_token == page_token else None,
+    }, errors
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket, used to limit the rate of API calls shared between workers
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: float Number of tokens added per second
+        :param capacity: int Maximum number of tokens stored (defaults to rate, allowing one second of burst)
+        """
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, deadline=None):
+        """
+        Takes one token from the bucket, waiting for it to be refilled if needed
+        :param deadline: float Unix timestamp after which we stop waiting or None to wait as long as needed
+        :return: True if the token was taken, False if it wouldn't be available before the deadline
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+
+            if deadline is not None and now + delay > deadline:
+                return False
+
+            time.sleep(delay)
+
+
+class LocalFileStore(object):
+    """
+    Keeps state of unfinished runs in local JSON files. Those only survive between executions in the same Lambda
+    container - replace STATE_STORE with any object with the same load/save methods to use other storage.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: string Path of the files, with {} placeholder for the key
+        """
+        self.path = path
+
+    def load(self, key):
+        """
+        Loads saved state
+        :param key: string Name of the state (region name)
+        :return: dict Saved state or None if there is none
+        """
+        if not os.path.exists(self.path.format(key)):
+            return None
+
+        with open(self.path.format(key)) as state_file:
+            return json.load(state_file)
+
+    def save(self, key, state):
+        """
+        Saves state, so the next run can continue from there
+        :param key: string Name of the state (region name)
+        :param state: dict State to save or None to remove saved state
+        """
+        if not state:
+            if os.path.exists(self.path.format(key)):
+                os.remove(self.path.format(key))
+            return
+
+        with open(self.path.format(key), "w") as state_file:
+            json.dump(state, state_file)
+
+
+# Where to keep state of unfinished runs, so the next run can continue from there
+STATE_STORE = LocalFileStore("/tmp/ebs-snapshots-state-{}.json")
+
+
+def get_expiry_filters(full_scan, today):
+    """
+    Builds filters for describe_snapshots call listing our expired snapshots
+    :param full_scan: bool True to list all snapshots with DeleteOn tag, False to only list those with DeleteOn date
+    within last EXPIRY_LOOKBACK_DAYS days (including today)
+    :param today: datetime.date Date of this run
+    :return: List of filters
+    """
+    if full_scan:
+        return [
             {"Name": "tag-key", "Values": [DELETE_ON_TAG]},
-        ],
+        ]
+
+    dates = [today - datetime.timedelta(days=days) for days in range(min(EXPIRY_LOOKBACK_DAYS, 200))]
+    return [
+        {"Name": "tag:" + DELETE_ON_TAG, "Values": [date.strftime("%Y-%m-%d") for date in dates]},
+    ]
+
+
+def delete_snapshot(ec2_client, snapshot_id, bucket, deadline, stats, stats_lock):
+    """
+    Deletes a single snapshot, respecting the shared rate limit and retrying when throttled or failed with
+    a transient error
+    :param ec2_client: boto3 EC2 client for the region
+    :param snapshot_id: string ID of the snapshot
+    :param bucket: TokenBucket shared by all deleting workers
+    :param deadline: float Unix timestamp after which the snapshot is skipped
+    :param stats: Counter with deleted/failed/throttled/skipped counts, updated in place
+    :param stats_lock: threading.Lock guarding stats
+    :return: True if snapshot was processed (deleted or failed), False if it was skipped due to deadline
+    """
+    # Errors of the attempts that were retried
+    retried = []
+
+    def before_retry(error):
+        retried.append(error)
+        # Every retry is rate limited too, but not past the deadline
+        return bucket.take(deadline)
+
+    # Don't wait for the rate limit if there's no time left anyway, waiting could also take us past the deadline
+    if time.time() > deadline or not bucket.take(deadline):
+        result = "skipped"
+    else:
+        try:
+            call_with_backoff(ec2_client.delete_snapshot, deadline, before_retry, SnapshotId=snapshot_id)
+            print("Deleted old snapshot: {}".format(snapshot_id))
+            result = "deleted"
+        except Exception as e:  # Any failure only fails this snapshot, so the others and the run's position aren't lost
+            retried.append(e)
+            # Leave it for the next run if it couldn't be retried in time
+            if is_retryable(e) and len(retried) <= MAX_RETRIES:
+                result = "skipped"
+            else:
+                print("Failed to delete snapshot {}: {}".format(snapshot_id, e))
+                result = "failed"
+
+    with stats_lock:
+        stats[result] += 1
+        stats["throttled"] += sum(1 for error in retried if get_error_code(error) in THROTTLING_ERRORS)
+    return result != "skipped"
+
+
+def remove_snapshots(ec2_client, deadline, cursor, today):
+    """
+    Find our old snapshots and remove as needed (when DeleteOn is today or earlier).
+    Expired snapshots are deleted by DELETE_WORKERS parallel workers, limited to DELETE_RATE deletions per second.
+    If the deadline is reached, the position is returned, so the next run can continue from there.
+    Only snapshots with DeleteOn date in last EXPIRY_LOOKBACK_DAYS days are listed, except for every
+    FULL_SCAN_INTERVAL days, when all snapshots with DeleteOn tag are.
+    :param ec2_client: boto3 EC2 client for the region
+    :param deadline: float Unix timestamp after which no more snapshots are deleted
+    :param cursor: dict Position saved by previous run or None to start from the beginning
+    :param today: datetime.date Date of this run
+    :return: Tuple of dict with number of deleted, failed, throttled and skipped snapshots
+    and position to continue from in the next run (None if all snapshots were processed)
+    """
+    stats = collections.Counter(deleted=0, failed=0, throttled=0, skipped=0)
+    stats_lock = threading.Lock()
+    bucket = TokenBucket(DELETE_RATE)
+
+    region = ec2_client.meta.region_name
+    if cursor is not None:
+        starting_token = cursor["NextToken"]
+        full_scan = cursor["FullScan"]
+        print("Resuming removal of old snapshots from previous run")
+    else:
+        starting_token = None
+        full_scan = today.toordinal() % FULL_SCAN_INTERVAL == 0
+
+    if full_scan:
+        print("Looking through all snapshots with {} tag".format(DELETE_ON_TAG))
+
+    response_iterator = get_pages(
+        ec2_client.describe_snapshots,
+        deadline,
+        OwnerIds=["self"],
+        Filters=get_expiry_filters(full_scan, today),
+        MaxResults=1000,
+        NextToken=starting_token,
     )
 
-    for snapshots in response_iterator:
-        for snapshot in snapshots["Snapshots"]:
-            delete_date = find_delete_tag(snapshot["Tags"])
+    # Token needed to fetch each page again, by page number (None for the first page)
+    page_tokens = []
+    next_token = starting_token
+    # Pages with snapshots that weren't deleted (or even submitted) before the deadline
+    skipped_pages = []
+    futures = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        for page_token, snapshots in response_iterator:
+            page = len(page_tokens)
+            page_tokens.append(page_token)
+            next_token = snapshots.get("NextToken") or None
+
+            delete_dates = ((snapshot, find_delete_tag(snapshot["Tags"])) for snapshot in snapshots["Snapshots"])
+            expired = [snapshot for snapshot, delete_date in delete_dates
+                       if delete_date is not None and delete_date <= today]
+            for position, snapshot in enumerate(expired):
+                # Only list as far ahead as workers can keep up with, so nothing is queued past the deadline
+                while len(pending) >= DELETE_WORKERS:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                if time.time() > deadline:
+                    # The rest of the page is left for the next run too
+                    with stats_lock:
+                        stats["skipped"] += len(expired) - position
+                    skipped_pages.append(page)
+                    break
 
-            if delete_date is not None and delete_date <= TODAY:
-                print("Deleting old snapshot: {}".format(snapshot["SnapshotId"]))
-                EC2_CLIENT.delete_snapshot(
-                    SnapshotId=snapshot["SnapshotId"],
+                future = executor.submit(
+                    delete_snapshot, ec2_client, snapshot["SnapshotId"], bucket, deadline, stats, stats_lock
                 )
+                futures.append((page, future))
+                pending.add(future)
+
+            if skipped_pages or time.time() > deadline:
+                break
+
+    skipped_pages.extend(page for page, future in futures if not future.result())
+
+    # Resume from the first page with skipped snapshots, after the last listed page or start over next time
+    if skipped_pages:
+        unfinished = True
+        resume_token = page_tokens[min(skipped_pages)]
+    else:
+        unfinished = next_token is not None
+        resume_token = next_token
+
+    print("Old snapshots in {region}: {deleted} deleted, {failed} failed, {throttled} throttled, "
+          "{skipped} left for next run{more}".format(
+              region=region, more=" (and more not listed yet)" if next_token is not None else "", **stats))
+
+    if not unfinished:
+        return dict(stats), None
+
+    return dict(stats), {"NextToken": resume_token, "FullScan": full_scan}
+
+
+def process_region(region, context, deadline, state, today):
+    """
+    Creates new snapshots and removes old ones in a single region. Creating snapshots can use up to CREATE_TIME_SHARE
+    of the time left, so removing old ones always gets its share of time too.
+    :param region: string Name of the region or None for the region Lambda runs in
+    :param context: Lambda context object
+    :param deadline: float Unix timestamp after which no more work is started
+    :param state: dict Positions saved by previous, unfinished run (with its date and whether all snapshots were
+    created) or None
+    :param today: datetime.date Date of this run
+    :return: Tuple of dict with number of deleted, failed, throttled and skipped snapshots, state to continue from
+    in the next run (None if everything was done) and list of errors from instances that failed
+    """
+    ec2_client = get_ec2_client(region)
+    state = state or {}
+
+    # State from another day: today's snapshots still have to be created and expiry filters have changed,
+    # only unfinished full scan can be continued
+    if state.get("date") != today.isoformat():
+        remove_cursor = state.get("remove")
+        state = {"remove": remove_cursor if remove_cursor and remove_cursor["FullScan"] else None}
+
+    # Once all snapshots were created today, the rest of the run only removes old ones (no cursor means the start)
+    if state.get("created"):
+        create_cursor, errors = None, []
+    else:
+        create_deadline = time.time() + (deadline - time.time()) * CREATE_TIME_SHARE
+        create_cursor, errors = create_snapshots(ec2_client, context, create_deadline, state.get("create"), today)
+    stats, remove_cursor = remove_snapshots(ec2_client, deadline, state.get("remove"), today)
+
+    if create_cursor is None and remove_cursor is None:
+        return stats, None, errors
+
+    return stats, {
+        "date": today.isoformat(),
+        "created": create_cursor is None,
+        "create": create_cursor,
+        "remove": remove_cursor,
+    }, errors
+
+
+def continue_in_new_execution(context, continuation, states):
+    """
+    Invokes this Lambda asynchronously to continue unfinished work
+    :param context: Lambda context object
+    :param continuation: int Number of this continuation
+    :param states: dict States to continue from, by region name
+    """
+    print("Not everything was done in time, continuing in new execution ({} of {})".format(
+        continuation, MAX_CONTINUATIONS))
+
+    boto3.client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({"continuation": continuation, "state": states}),
+    )
 
 
 def lambda_handler(event, context):
-    create_snapshots(context)
-    remove_snapshots()
+    # All regions share the same deadline, as they are processed at the same time
+    deadline = get_deadline(context)
+    # Containers are reused between executions, so the date has to be checked on every one
+    today = datetime.date.today()
+    regions = dict((get_ec2_client(region).meta.region_name, region) for region in REGIONS or [None])
+
+    # State passed from previous execution of this run takes precedence over the stored one
+    event = event if isinstance(event, dict) else {}
+    continuation = event.get("continuation", 0)
+    if "state" in event:
+        # Continuation of previous execution, only regions that weren't finished there are left
+        regions = dict((region_name, region) for region_name, region in regions.items()
+                       if region_name in event["state"])
+    states = dict((region_name, event.get("state", {}).get(region_name) or STATE_STORE.load(region_name))
+                  for region_name in regions)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(regions))) as executor:
+        futures = dict(
+            (region_name, executor.submit(process_region, region, context, deadline, states[region_name], today))
+            for region_name, region in regions.items()
+        )
+
+    # Let all regions finish before reporting any failures
+    results = {}
+    unfinished = {}
+    errors = []
+    # Errors of regions which are continued in the new execution, the others are done (or failed outright)
+    unfinished_errors = []
+    for region_name, future in futures.items():
+        try:
+            stats, state, region_errors = future.result()
+            results[region_name] = stats
+        except Exception as e:
+            print("Processing region {} failed: {}".format(region_name, e))
+            region_errors = [e]
+            # Saved state may be the reason of the failure, start from the beginning next time
+            state = None
+
+        STATE_STORE.save(region_name, state)
+        if state:
+            unfinished[region_name] = state
+            unfinished_errors.extend(region_errors)
+        else:
+            errors.extend(region_errors)
+
+    if unfinished and continuation < MAX_CONTINUATIONS:
+        continue_in_new_execution(context, continuation + 1, unfinished)
+
+        # Failing only because of unfinished regions would make Lambda retry this execution, which would hand off
+        # the same work again - errors of the regions which are done can't be left unreported, though
+        for error in unfinished_errors:
+            print("Error: {}".format(error))
+        unfinished_errors = []
+
+    errors.extend(unfinished_errors)
+    if errors:
+        raise errors[0]
+
+    return results
@@ -62,6 +62,7 @@ lambda_role = template.add_resource(iam.Role(
                 Action=[
                     aws.Action("ec2", "Describe*"),
                     aws.Action("ec2", "CreateSnapshot"),
+                    aws.Action("ec2", "CreateSnapshots"),
                     aws.Action("ec2", "DeleteSnapshot"),
                     aws.Action("ec2", "CreateTags"),
                     aws.Action("ec2", "ModifySnapshotAttribute"),
@@ -96,6 +97,22 @@ lambda_function = template.add_resource(awslambda.Function(
     Timeout=30
 ))
 
+# Lambda invokes itself to continue unfinished work - allowed in a separate policy, as the function depends on the role
+template.add_resource(iam.PolicyType(
+    "LambdaInvokeSelfPolicy",
+    PolicyName="InvokeSelf",
+    PolicyDocument=aws.Policy(Statement=[
+        aws.Statement(
+            Effect=aws.Allow,
+            Action=[
+                aws.Action("lambda", "InvokeFunction"),
+            ],
+            Resource=[GetAtt(lambda_function, "Arn")]
+        ),
+    ]),
+    Roles=[Ref(lambda_role)],
+))
+
 schedule_event = template.add_resource(events.Rule(
     "LambdaTriggerRule",
     Description="Trigger EBS snapshot Lambda",
@@ -19,6 +19,19 @@ param_alarm_email = t.add_parameter(Parameter(
     Type="String",
 ))
 
+param_s3_bucket = t.add_parameter(Parameter(
+    "S3BucketParameter",
+    Description="Name of the S3 bucket where you uploaded the clean-es-indices zip",
+    Type="String",
+))
+
+param_es_source_zip = t.add_parameter(Parameter(
+    "ESSourceZipParameter",
+    Description="Name of the clean-es-indices zip file inside the S3 bucket",
+    Default="clean-es-indices.zip",
+    Type="String",
+))
+
 ec_images_role = t.add_resource(Role(
     "LambdaCleanImagesRole",
     AssumeRolePolicyDocument=Policy(
@@ -132,20 +145,15 @@ release_function = t.add_resource(Function(
     Timeout=10
 ))
 
-source_file = os.path.realpath(__file__ + '/../../../clean-es-indices.py')
-with open(source_file, 'r') as content_file:
-    content = content_file.read()
-
-if len(content) > 4096:
-    raise Exception("Clean ES function too long! Has " + str(len(content)))
-
+# Too big to be inlined as ZipFile, deployed from zip uploaded to S3
 clea_es_function = t.add_resource(Function(
     'LambdaCleanESFunction',
     Description='Removes old ElasticSearch indexes',
     Code=Code(
-        ZipFile=content
+        S3Bucket=Ref(param_s3_bucket),
+        S3Key=Ref(param_es_source_zip)
     ),
-    Handler='index.lambda_handler',
+    Handler='clean-es-indices.lambda_handler',
     MemorySize=128,
     Role=GetAtt(es_exec_role, 'Arn'),
     Runtime='python2.7',
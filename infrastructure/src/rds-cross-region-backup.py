@@ -1,6 +1,7 @@
 from awacs import aws, sts
-from troposphere import Template, GetAtt, Join, Ref, Parameter, Equals, If, AWS_NO_VALUE, AWS_REGION
-from troposphere import awslambda, iam, sns, rds, events
+from troposphere import Template, GetAtt, Join, Ref, Parameter, Equals, If, And, Not, Condition, Split, AWS_NO_VALUE, \
+    AWS_REGION, AWS_ACCOUNT_ID, AWS_STACK_NAME
+from troposphere import awslambda, iam, sns, sqs, rds, events
 
 template = Template()
 
@@ -9,9 +10,9 @@ template.add_description('Resources copying RDS backups to another region')
 target_region_parameter = template.add_parameter(Parameter(
     "TargetRegionParameter",
     Type="String",
-    Description="Region where to store the copies of snapshots (for example: eu-central-1)",
-    AllowedPattern="^[a-z]+-[a-z]+-[0-9]+$",
-    ConstraintDescription="The target region needs to be valid AWS region, for example: us-east-1"
+    Description="Region where to store the copies of snapshots (for example: eu-central-1). Provide comma-delimited list to store copies in more than one region.",
+    AllowedPattern="^[a-z]+-[a-z]+-[0-9]+(,[a-z]+-[a-z]+-[0-9]+)*$",
+    ConstraintDescription="The target regions need to be valid AWS regions, for example: us-east-1 or us-east-1,eu-central-1"
 ))
 
 databases_to_use_parameter = template.add_parameter(Parameter(
@@ -28,6 +29,14 @@ include_aurora_clusters_parameter = template.add_parameter(Parameter(
     Description="Choose 'Yes' if you have Aurora Clusters that you want to use this for, will add daily schedule."
 ))
 
+incremental_aurora_parameter = template.add_parameter(Parameter(
+    "IncrementalAurora",
+    Type="String",
+    AllowedValues=["Yes", "No"],
+    Default="No",
+    Description="Choose 'Yes' to copy Aurora snapshots as soon as they're created and only check clusters with new snapshots in daily schedule."
+))
+
 clusters_to_use_parameter = template.add_parameter(Parameter(
     "ClustersToUse",
     Type="String",
@@ -38,7 +47,48 @@ clusters_to_use_parameter = template.add_parameter(Parameter(
 kms_key_parameter = template.add_parameter(Parameter(
     "KMSKeyParameter",
     Type="String",
-    Description="KMS Key ARN in target region. Required if using encrypted RDS instances, optional otherwise.",
+    Description="KMS Key ARN in target region (comma-delimited list of key ARNs, one in each region, if using more than one target region). Required if using encrypted RDS instances, optional otherwise.",
+))
+
+keep_daily_parameter = template.add_parameter(Parameter(
+    "KeepDailyParameter",
+    Type="Number",
+    Default="1",
+    MinValue="1",
+    Description="How many days to keep the latest copy from in target region (the latest copy is always kept)",
+))
+
+keep_weekly_parameter = template.add_parameter(Parameter(
+    "KeepWeeklyParameter",
+    Type="Number",
+    Default="0",
+    MinValue="0",
+    Description="How many weeks to keep the latest copy from in target region",
+))
+
+keep_monthly_parameter = template.add_parameter(Parameter(
+    "KeepMonthlyParameter",
+    Type="Number",
+    Default="0",
+    MinValue="0",
+    Description="How many months to keep the latest copy from in target region",
+))
+
+track_copies_parameter = template.add_parameter(Parameter(
+    "TrackCopiesParameter",
+    Type="String",
+    AllowedValues=["Yes", "No"],
+    Default="No",
+    Description="Choose 'Yes' to log progress and throughput of copies still in progress in target region"
+))
+
+batch_window_parameter = template.add_parameter(Parameter(
+    "BatchWindowParameter",
+    Type="Number",
+    Default="0",
+    MinValue="0",
+    MaxValue="300",
+    Description="Number of seconds to collect RDS backup notifications in SQS queue, so that backups finishing at the same time are copied by a single Lambda execution. Leave 0 to trigger Lambda for every notification."
 ))
 
 s3_bucket_parameter = template.add_parameter(Parameter(
@@ -58,6 +108,12 @@ source_zip_parameter = template.add_parameter(Parameter(
 template.add_condition("UseAllDatabases", Equals(Join("", Ref(databases_to_use_parameter)), ""))
 template.add_condition("UseEncryption", Equals(Ref(kms_key_parameter), ""), )
 template.add_condition("IncludeAurora", Equals(Ref(include_aurora_clusters_parameter), "Yes"))
+template.add_condition("UseQueue", Not(Equals(Ref(batch_window_parameter), "0")))
+template.add_condition("TrackCopies", Equals(Ref(track_copies_parameter), "Yes"))
+template.add_condition("UseIncrementalAurora", And(
+    Condition("IncludeAurora"),
+    Equals(Ref(incremental_aurora_parameter), "Yes")
+))
 
 template.add_metadata({
     "AWS::CloudFormation::Interface": {
@@ -80,12 +136,24 @@ template.add_metadata({
                     "KMSKeyParameter",
                 ]
             },
+            {
+                "Label": {
+                    "default": "Optional: retention of copies in target region"
+                },
+                "Parameters": [
+                    "KeepDailyParameter",
+                    "KeepWeeklyParameter",
+                    "KeepMonthlyParameter",
+                    "TrackCopiesParameter",
+                ]
+            },
             {
                 "Label": {
                     "default": "Optional: limit to specific RDS database(s)"
                 },
                 "Parameters": [
                     "DatabasesToUse",
+                    "BatchWindowParameter",
                 ]
             },
             {
@@ -94,22 +162,53 @@ template.add_metadata({
                 },
                 "Parameters": [
                     "IncludeAuroraClusters",
-                    "ClustersToUse"
+                    "ClustersToUse",
+                    "IncrementalAurora",
                 ]
             },
         ],
         "ParameterLabels": {
-            "TargetRegionParameter": {"default": "Target region"},
+            "TargetRegionParameter": {"default": "Target region(s)"},
             "DatabasesToUse": {"default": "Databases to use for"},
-            "KMSKeyParameter": {"default": "KMS Key in target region"},
+            "KMSKeyParameter": {"default": "KMS Key in target region(s)"},
             "IncludeAuroraClusters": {"default": "Use for Aurora clusters"},
             "ClustersToUse": {"default": "Aurora clusters to use for"},
+            "IncrementalAurora": {"default": "Copy Aurora snapshots incrementally"},
+            "KeepDailyParameter": {"default": "Daily copies to keep"},
+            "KeepWeeklyParameter": {"default": "Weekly copies to keep"},
+            "KeepMonthlyParameter": {"default": "Monthly copies to keep"},
+            "TrackCopiesParameter": {"default": "Report copy progress"},
+            "BatchWindowParameter": {"default": "Batch window for RDS notifications"},
             "S3BucketParameter": {"default": "Name of S3 bucket"},
             "SourceZipParameter": {"default": "Name of ZIP file"},
         }
     }
 })
 
+# Path of SSM parameters (created by Lambda, one for each cluster) with time of the latest copied snapshot of each
+# Aurora cluster, for incremental copies
+watermark_path = Join("", ["/", Ref(AWS_STACK_NAME), "/aurora-watermarks"])
+# Path of SSM parameters with copies in progress, so the next run can report the ones which finished
+copies_path = Join("", ["/", Ref(AWS_STACK_NAME), "/copies-in-progress"])
+
+# Notifications which failed to be processed too many times end up here
+backup_dead_letter_queue = template.add_resource(sqs.Queue(
+    "RDSBackupDeadLetterQueue",
+    Condition="UseQueue",
+    MessageRetentionPeriod=1209600,  # 14 days, the maximum
+))
+
+# Queue collecting RDS notifications, to copy many snapshots in one Lambda execution
+backup_queue = template.add_resource(sqs.Queue(
+    "RDSBackupQueue",
+    Condition="UseQueue",
+    VisibilityTimeout=600,  # Lambda timeout multiplied by 6, plus maximum batch window
+    RedrivePolicy=sqs.RedrivePolicy(
+        deadLetterTargetArn=GetAtt(backup_dead_letter_queue, "Arn"),
+        maxReceiveCount=5,
+    ),
+))
+
 # Role for Lambda
 backup_rds_role = template.add_resource(iam.Role(
     "LambdaBackupRDSRole",
@@ -159,8 +258,61 @@ backup_rds_role = template.add_resource(iam.Role(
                         aws.Action('kms', 'Create*'),  # Don't ask me why this is needed...
                         aws.Action('kms', 'DescribeKey'),
                     ],
-                    Resource=[Ref(kms_key_parameter)]
+                    Resource=Split(",", Ref(kms_key_parameter))
+                ),
+            ),
+            If(
+                "UseIncrementalAurora",
+                aws.Statement(
+                    Effect=aws.Allow,
+                    Action=[
+                        aws.Action('ssm', 'GetParameter'),
+                        aws.Action('ssm', 'GetParametersByPath'),
+                        aws.Action('ssm', 'PutParameter'),
+                    ],
+                    Resource=[
+                        Join("", [
+                            "arn:aws:ssm:", Ref(AWS_REGION), ":", Ref(AWS_ACCOUNT_ID), ":parameter", watermark_path
+                        ]),
+                        Join("", [
+                            "arn:aws:ssm:", Ref(AWS_REGION), ":", Ref(AWS_ACCOUNT_ID), ":parameter", watermark_path, "/*"
+                        ]),
+                    ]
                 ),
+                Ref(AWS_NO_VALUE),
+            ),
+            If(
+                "TrackCopies",
+                aws.Statement(
+                    Effect=aws.Allow,
+                    Action=[
+                        aws.Action('ssm', 'GetParametersByPath'),
+                        aws.Action('ssm', 'PutParameter'),
+                        aws.Action('ssm', 'DeleteParameters'),
+                    ],
+                    Resource=[
+                        Join("", [
+                            "arn:aws:ssm:", Ref(AWS_REGION), ":", Ref(AWS_ACCOUNT_ID), ":parameter", copies_path
+                        ]),
+                        Join("", [
+                            "arn:aws:ssm:", Ref(AWS_REGION), ":", Ref(AWS_ACCOUNT_ID), ":parameter", copies_path, "/*"
+                        ]),
+                    ]
+                ),
+                Ref(AWS_NO_VALUE),
+            ),
+            If(
+                "UseQueue",
+                aws.Statement(
+                    Effect=aws.Allow,
+                    Action=[
+                        aws.Action('sqs', 'ReceiveMessage'),
+                        aws.Action('sqs', 'DeleteMessage'),
+                        aws.Action('sqs', 'GetQueueAttributes'),
+                    ],
+                    Resource=[GetAtt(backup_queue, "Arn")]
+                ),
+                Ref(AWS_NO_VALUE),
             ),
         ])
     )]
@@ -181,20 +333,61 @@ backup_rds_function = template.add_resource(awslambda.Function(
     Environment=awslambda.Environment(
         Variables={
             'SOURCE_REGION': Ref(AWS_REGION),
-            'TARGET_REGION': Ref(target_region_parameter),
+            'TARGET_REGIONS': Ref(target_region_parameter),
             'KMS_KEY_ID': Ref(kms_key_parameter),
-            'CLUSTERS_TO_USE': Ref(clusters_to_use_parameter)
+            'CLUSTERS_TO_USE': Ref(clusters_to_use_parameter),
+            'KEEP_DAILY': Ref(keep_daily_parameter),
+            'KEEP_WEEKLY': Ref(keep_weekly_parameter),
+            'KEEP_MONTHLY': Ref(keep_monthly_parameter),
+            'TRACK_COPIES': Ref(track_copies_parameter),
+            'COPIES_PATH': If("TrackCopies", copies_path, ""),
+            'WATERMARK_PATH': If("UseIncrementalAurora", watermark_path, ""),
         }
     )
 ))
 
-# SNS topic for event subscriptions
+# SNS topic for event subscriptions, delivering to Lambda directly or through the queue
 rds_topic = template.add_resource(sns.Topic(
     'RDSBackupTopic',
-    Subscription=[sns.Subscription(
-        Protocol="lambda",
-        Endpoint=GetAtt(backup_rds_function, 'Arn'),
-    )]
+    Subscription=If(
+        "UseQueue",
+        [sns.Subscription(
+            Protocol="sqs",
+            Endpoint=GetAtt(backup_queue, 'Arn'),
+        )],
+        [sns.Subscription(
+            Protocol="lambda",
+            Endpoint=GetAtt(backup_rds_function, 'Arn'),
+        )]
+    )
+))
+
+# Permission for SNS to send messages to the queue
+template.add_resource(sqs.QueuePolicy(
+    "RDSBackupQueuePolicy",
+    Condition="UseQueue",
+    Queues=[Ref(backup_queue)],
+    PolicyDocument=aws.Policy(Statement=[
+        aws.Statement(
+            Effect=aws.Allow,
+            Action=[aws.Action('sqs', 'SendMessage')],
+            Principal=aws.Principal("Service", ["sns.amazonaws.com"]),
+            Resource=[GetAtt(backup_queue, "Arn")],
+            Condition=aws.Condition(aws.ArnEquals("aws:SourceArn", Ref(rds_topic)))
+        )
+    ])
+))
+
+# Lambda reads notifications from the queue in batches, waiting up to the batch window to collect them
+template.add_resource(awslambda.EventSourceMapping(
+    "RDSBackupQueueMapping",
+    Condition="UseQueue",
+    EventSourceArn=GetAtt(backup_queue, "Arn"),
+    FunctionName=Ref(backup_rds_function),
+    BatchSize=100,
+    MaximumBatchingWindowInSeconds=Ref(batch_window_parameter),
+    # Only notifications of databases which failed are retried
+    FunctionResponseTypes=["ReportBatchItemFailures"],
 ))
 
 # Event subscription - RDS will notify SNS when backup is started and finished
@@ -240,4 +433,34 @@ template.add_resource(awslambda.Permission(
     SourceArn=GetAtt(schedule_event, "Arn")
 ))
 
+snapshot_event = template.add_resource(events.Rule(
+    "AuroraSnapshotEvent",
+    Condition="UseIncrementalAurora",
+    Description="Copy new Aurora cluster snapshots to another region",
+    EventPattern={
+        "source": ["aws.rds"],
+        "detail-type": ["RDS DB Cluster Snapshot Event"],
+        "detail": {
+            "EventID": ["RDS-EVENT-0169"]
+        }
+    },
+    State="ENABLED",
+    Targets=[
+        events.Target(
+            Arn=GetAtt(backup_rds_function, "Arn"),
+            Id="backup_rds_function"
+        )
+    ]
+))
+
+# Permission for EventBridge to trigger the Lambda on new snapshots
+template.add_resource(awslambda.Permission(
+    "SnapshotEventsPermissionForLambda",
+    Condition="UseIncrementalAurora",
+    Action="lambda:invokeFunction",
+    FunctionName=Ref(backup_rds_function),
+    Principal="events.amazonaws.com",
+    SourceArn=GetAtt(snapshot_event, "Arn")
+))
+
 print(template.to_json())
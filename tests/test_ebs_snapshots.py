@@ -0,0 +1,314 @@
+import datetime
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+import botocore.exceptions  # noqa: E402
+from botocore.stub import ANY, Stubber  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE_PATH = os.path.join(ROOT, "ebs-snapshots.py")
+
+# Shared aws_calls module is imported from the same directory, like in the Lambda's zip
+sys.path.insert(0, ROOT)
+import aws_calls  # noqa: E402
+
+TODAY = datetime.date(2026, 10, 16)
+
+
+def load_module():
+    """
+    Loads ebs-snapshots.py, which can't be imported by name because of the dash
+    :return: module
+    """
+    spec = importlib.util.spec_from_file_location("ebs_snapshots", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Context(object):
+    function_name = "ebs-snapshots"
+
+
+def instance(instance_id, volume_ids):
+    """
+    Builds describe_instances output for an instance with Backup tag, first volume being the boot volume
+    :param instance_id: string ID of the instance
+    :param volume_ids: list IDs of attached volumes
+    :return: dict Instance details
+    """
+    return {
+        "InstanceId": instance_id,
+        "RootDeviceName": "/dev/xvda",
+        "Tags": [{"Key": "Backup", "Value": "3"}, {"Key": "Name", "Value": instance_id}],
+        "BlockDeviceMappings": [
+            {"DeviceName": "/dev/xvda" if index == 0 else "/dev/xvd" + chr(ord("b") + index),
+             "Ebs": {"VolumeId": volume_id}}
+            for index, volume_id in enumerate(volume_ids)
+        ],
+    }
+
+
+@pytest.fixture
+def ebs():
+    module = load_module()
+    # One worker, so that the order of create_snapshots calls matches the order of stubbed responses
+    module.MAX_WORKERS = 1
+    return module
+
+
+@pytest.fixture
+def ec2_client(ebs):
+    return boto3.client("ec2", region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing",
+                        config=aws_calls.CLIENT_CONFIG)
+
+
+def test_one_create_snapshots_call_per_instance(ebs, ec2_client):
+    instances = [
+        instance("i-00000001", ["vol-00000011", "vol-00000012", "vol-00000013"]),
+        instance("i-00000002", ["vol-00000021", "vol-00000022"]),
+    ]
+    volume_count = sum(len(i["BlockDeviceMappings"]) for i in instances)
+    tags = [
+        {"Key": "Name", "Value": "i-00000001"},
+        {"Key": "DeleteOn", "Value": "2026-10-19"},
+        {"Key": "CreatedBy", "Value": "ebs-snapshots"},
+    ]
+
+    calls = []
+    ec2_client.meta.events.register("provide-client-params.ec2.*",
+                                    lambda params, model, **kwargs: calls.append(model.name))
+
+    stubber = Stubber(ec2_client)
+    # Today's snapshots are looked up once for all volumes: one was already done by an earlier run
+    stubber.add_response("describe_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000001", "VolumeId": "vol-00000012",
+         "StartTime": datetime.datetime(2026, 10, 16, 1, tzinfo=datetime.timezone.utc)},
+    ]}, {"OwnerIds": ["self"], "MaxResults": 1000, "Filters": [
+        {"Name": "tag-key", "Values": ["DeleteOn"]},
+        {"Name": "status", "Values": ["pending", "completed"]},
+        {"Name": "start-time", "Values": ["2026-10-16*"]},
+    ]})
+    stubber.add_response("describe_instances", {"Reservations": [{"Instances": instances}]},
+                         {"Filters": [{"Name": "tag-key", "Values": ["Backup"]}]})
+    stubber.add_response("create_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000011", "VolumeId": "vol-00000011"},
+        {"SnapshotId": "snap-00000013", "VolumeId": "vol-00000013"},
+    ]}, {
+        "InstanceSpecification": {"InstanceId": "i-00000001", "ExcludeBootVolume": False,
+                                  "ExcludeDataVolumeIds": ["vol-00000012"]},
+        "Description": "Snapshot from instance i-00000001",
+        "TagSpecifications": [{"ResourceType": "snapshot", "Tags": tags}],
+    })
+    stubber.add_response("create_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000021", "VolumeId": "vol-00000021"},
+        {"SnapshotId": "snap-00000022", "VolumeId": "vol-00000022"},
+    ]}, {
+        "InstanceSpecification": {"InstanceId": "i-00000002", "ExcludeBootVolume": False},
+        "Description": "Snapshot from instance i-00000002",
+        "TagSpecifications": [{"ResourceType": "snapshot", "Tags": [
+            {"Key": "Name", "Value": "i-00000002"},
+            {"Key": "DeleteOn", "Value": "2026-10-19"},
+            {"Key": "CreatedBy", "Value": "ebs-snapshots"},
+        ]}],
+    })
+
+    with stubber:
+        cursor, errors = ebs.create_snapshots(ec2_client, Context(), time.time() + 60, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert cursor is None
+    assert errors == []
+    assert calls == ["DescribeSnapshots", "DescribeInstances", "CreateSnapshots", "CreateSnapshots"]
+    # Previously: a describe_snapshots, a create_snapshot and a create_tags call for every volume
+    assert len(calls) < 3 * volume_count
+
+
+def test_instance_with_all_volumes_done_is_skipped(ebs, ec2_client):
+    calls = []
+    ec2_client.meta.events.register("provide-client-params.ec2.*",
+                                    lambda params, model, **kwargs: calls.append(model.name))
+
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000001", "VolumeId": "vol-00000011",
+         "StartTime": datetime.datetime(2026, 10, 16, 1, tzinfo=datetime.timezone.utc)},
+        # Snapshot from yesterday doesn't count
+        {"SnapshotId": "snap-00000002", "VolumeId": "vol-00000012",
+         "StartTime": datetime.datetime(2026, 10, 15, 1, tzinfo=datetime.timezone.utc)},
+    ]})
+    stubber.add_response("describe_instances", {"Reservations": [{"Instances": [
+        instance("i-00000001", ["vol-00000011"]),
+        instance("i-00000002", ["vol-00000012"]),
+    ]}]})
+    stubber.add_response("create_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000012", "VolumeId": "vol-00000012"},
+    ]}, {
+        "InstanceSpecification": {"InstanceId": "i-00000002", "ExcludeBootVolume": False},
+        "Description": "Snapshot from instance i-00000002",
+        "TagSpecifications": ANY,
+    })
+
+    with stubber:
+        cursor, errors = ebs.create_snapshots(ec2_client, Context(), time.time() + 60, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert (cursor, errors) == (None, [])
+    assert calls == ["DescribeSnapshots", "DescribeInstances", "CreateSnapshots"]
+
+
+def test_transient_errors_are_retried(ebs, ec2_client, monkeypatch):
+    monkeypatch.setattr(aws_calls, "get_backoff", lambda attempt, deadline: 0)
+
+    stubber = Stubber(ec2_client)
+    stubber.add_client_error("describe_instances", "ServiceUnavailable", http_status_code=503)
+    stubber.add_client_error("describe_instances", "InternalError", http_status_code=500)
+    stubber.add_response("describe_instances", {"Reservations": []})
+    # Errors which aren't transient fail straight away
+    stubber.add_client_error("describe_instances", "UnauthorizedOperation", http_status_code=403)
+
+    with stubber:
+        assert ebs.call_with_backoff(ec2_client.describe_instances, time.time() + 60) == {"Reservations": []}
+        with pytest.raises(botocore.exceptions.ClientError):
+            ebs.call_with_backoff(ec2_client.describe_instances, time.time() + 60)
+
+    stubber.assert_no_pending_responses()
+
+
+def test_continuation_after_create_phase_only_removes(ebs, ec2_client):
+    ebs.EC2_CLIENTS["eu-west-1"] = ec2_client
+    calls = []
+    ec2_client.meta.events.register("provide-client-params.ec2.*",
+                                    lambda params, model, **kwargs: calls.append(model.name))
+
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": []},
+                         {"OwnerIds": ["self"], "Filters": ANY, "MaxResults": 1000, "NextToken": "page-2"})
+
+    state = {"date": TODAY.isoformat(), "created": True, "create": None,
+             "remove": {"NextToken": "page-2", "FullScan": False}}
+    with stubber:
+        stats, state, errors = ebs.process_region("eu-west-1", Context(), time.time() + 60, state, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert (state, errors) == (None, [])
+    assert calls == ["DescribeSnapshots"]
+
+
+def test_old_snapshots_are_removed_when_listing_instances_fails(ebs, ec2_client):
+    ebs.EC2_CLIENTS["eu-west-1"] = ec2_client
+    calls = []
+    ec2_client.meta.events.register("provide-client-params.ec2.*",
+                                    lambda params, model, **kwargs: calls.append(model.name))
+
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": []})
+    stubber.add_client_error("describe_instances", "UnauthorizedOperation", http_status_code=403)
+    stubber.add_response("describe_snapshots", {"Snapshots": []})
+
+    with stubber:
+        stats, state, errors = ebs.process_region("eu-west-1", Context(), time.time() + 60, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert calls == ["DescribeSnapshots", "DescribeInstances", "DescribeSnapshots"]
+    assert len(errors) == 1
+    # Listing failed for good, so there is nothing to continue
+    assert state is None
+
+
+def test_listing_throttled_at_deadline_is_continued(ebs, ec2_client, monkeypatch):
+    ebs.EC2_CLIENTS["eu-west-1"] = ec2_client
+    # No time left to retry
+    monkeypatch.setattr(aws_calls, "get_backoff", lambda attempt, deadline: None)
+
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": []})
+    stubber.add_client_error("describe_instances", "RequestLimitExceeded", http_status_code=503)
+    stubber.add_response("describe_snapshots", {"Snapshots": []})
+
+    with stubber:
+        stats, state, errors = ebs.process_region("eu-west-1", Context(), time.time() + 60, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert len(errors) == 1
+    # Creating snapshots is tried again from the start by the next run
+    assert state == {"date": TODAY.isoformat(), "created": False,
+                     "create": {"NextToken": None, "LastInstanceId": None}, "remove": None}
+
+
+def test_failed_region_is_reported_when_another_one_continues(ebs, monkeypatch):
+    class Store(object):
+        def load(self, key):
+            return None
+
+        def save(self, key, state):
+            pass
+
+    def process_region(region, context, deadline, state, today):
+        if region == "eu-west-1":
+            raise Exception("Region failed")
+        return {}, {"date": today.isoformat(), "created": True, "create": None, "remove": {}}, []
+
+    handed_off = []
+    monkeypatch.setattr(ebs, "REGIONS", ["eu-west-1", "eu-central-1"])
+    monkeypatch.setattr(ebs, "STATE_STORE", Store())
+    monkeypatch.setattr(ebs, "process_region", process_region)
+    monkeypatch.setattr(ebs, "continue_in_new_execution",
+                        lambda context, continuation, states: handed_off.append(sorted(states)))
+
+    class LambdaContext(Context):
+        def get_remaining_time_in_millis(self):
+            return 30000
+
+    with pytest.raises(Exception, match="Region failed"):
+        ebs.lambda_handler({}, LambdaContext())
+
+    assert handed_off == [["eu-central-1"]]
+
+
+def test_connection_error_fails_only_its_snapshot(ebs, ec2_client, monkeypatch):
+    monkeypatch.setattr(aws_calls, "get_backoff", lambda attempt, deadline: 0)
+    monkeypatch.setattr(ebs, "DELETE_WORKERS", 1)
+
+    def fail_first_snapshot(params, **kwargs):
+        if params["SnapshotId"] == "snap-00000001":
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url="https://ec2.eu-west-1.amazonaws.com")
+
+    ec2_client.meta.events.register("before-parameter-build.ec2.DeleteSnapshot", fail_first_snapshot)
+
+    expired = [{"Key": "DeleteOn", "Value": "2026-10-15"}]
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000001", "Tags": expired},
+        {"SnapshotId": "snap-00000002", "Tags": expired},
+    ]})
+    stubber.add_response("delete_snapshot", {})
+
+    with stubber:
+        stats, cursor = ebs.remove_snapshots(ec2_client, time.time() + 60, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert cursor is None
+    assert (stats["deleted"], stats["failed"]) == (1, 1)
+
+
+def test_snapshots_not_submitted_before_deadline_are_skipped(ebs, ec2_client):
+    expired = [{"Key": "DeleteOn", "Value": "2026-10-15"}]
+    stubber = Stubber(ec2_client)
+    stubber.add_response("describe_snapshots", {"Snapshots": [
+        {"SnapshotId": "snap-00000001", "Tags": expired},
+        {"SnapshotId": "snap-00000002", "Tags": [{"Key": "DeleteOn", "Value": "2026-10-20"}]},
+        {"SnapshotId": "snap-00000003", "Tags": expired},
+    ]})
+
+    with stubber:
+        stats, cursor = ebs.remove_snapshots(ec2_client, time.time() - 1, None, TODAY)
+
+    stubber.assert_no_pending_responses()
+    assert cursor == {"NextToken": None, "FullScan": False}
+    assert (stats["deleted"], stats["skipped"]) == (0, 2)